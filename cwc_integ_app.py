@@ -1,22 +1,46 @@
 import re
+import sys
 import time
 import json
+import socket
+import uuid
+import queue
 import docker
+import signal
+import threading
+import os
 from os import path, environ
-from datetime import datetime
-from flask import Flask, render_template, request
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from werkzeug.routing import PathConverter
+from flask import Flask, render_template, request, jsonify, Response
 from flask_wtf import Form
 from flask_pymongo import PyMongo
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from flask_bootstrap import Bootstrap
 from wtforms import SubmitField, StringField, validators
 from wtforms.fields.html5 import EmailField
 
+import metrics
+import docker_hosts
+import session_proxy
+from per_process import per_process
 from logs.get_logs import get_logs_for_container
 
 import logging
 
 DOCKER_IMAGE = 'cwc-integ'
 DOCKER_TAG = 'dev'
+# Images committed from a booted container of an interface, see
+# build_warm_image. They are labelled with the id of the image they were
+# built from so that they are not used once that image is rebuilt.
+WARM_IMAGE_TAG = DOCKER_TAG + '-warm-%s'
+BASE_IMAGE_LABEL = 'cwc-integ-service.base-image'
+# Containers started by the service carry this label, set to the interface.
+SESSION_LABEL = 'cwc-integ-service.interface'
 
 LOGGING_FMT = ('[%(asctime)s] %(levelname)s '
                '- %(funcName)s@%(lineno)s: %(message)s')
@@ -26,16 +50,72 @@ guni_logger = logging.getLogger('gunicorn.error')
 logger.handlers.extend(guni_logger.handlers)
 logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
 
-MAX_SESSIONS = 4
+# Admission control: start a session only if the host has room for the
+# expected CPU and memory footprint of its interface, see can_admit.
+ADMISSION_CONTROL = environ.get('CWC_ADMISSION_CONTROL', '') == '1'
+# The most sessions a docker host runs at the same time, unless set for the
+# host in CWC_DOCKER_HOSTS. With admission control on, the number of sessions
+# is limited by the resources of the host, and this is only a safety ceiling.
+MAX_SESSIONS = int(environ.get('CWC_MAX_SESSIONS',
+                               32 if ADMISSION_CONTROL else 4))
 class SessionLimitExceeded(Exception):
     pass
 
 
+class NoFreePorts(SessionLimitExceeded):
+    pass
+
+
+class InsufficientResources(SessionLimitExceeded):
+    pass
+
+
+# The interfaces that can be launched, with the port the interface listens on
+# inside the container, the path the user is redirected to, and roughly how
+# many seconds the container takes to boot.
+INTERFACES = {
+    'CLIC': {'expose_port': 8000, 'extension': '/clic/bio', 'time_out': 30},
+    'SBGN': {'expose_port': 3000, 'extension': '', 'time_out': 60},
+}
+
+# The number of idle, already booted containers to keep around for each
+# interface. Warm containers hold a session slot and count toward
+# MAX_SESSIONS.
+WARM_POOL_SIZE = {
+    'CLIC': int(environ.get('CWC_WARM_CLIC', 0)),
+    'SBGN': int(environ.get('CWC_WARM_SBGN', 0)),
+}
+
+# How users reach their session: 'ports' publishes a host port for each
+# container and sends users to it, 'proxy' has the service forward
+# /session/<container id>/ to the container (see session_proxy.py), so that
+# containers on the local host don't publish any port.
+ROUTING = environ.get('CWC_ROUTING', 'ports')
+PROXY_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+# The cookie naming the session requests with absolute paths are sent to.
+PROXY_COOKIE = 'cwc_session'
+
+# In recycle mode, the container of an ended session is reset and put back in
+# the warm pool if the pool is short, instead of being stopped. It is reset
+# by clearing the files its session left in RESET_PATHS and restarting it,
+# which runs its startup script again, or with RESET_COMMAND if the image
+# provides one. A container is recycled at most MAX_RECYCLES times.
+RECYCLE = environ.get('CWC_RECYCLE', '') == '1'
+RESET_COMMAND = environ.get('CWC_RESET_COMMAND')
+RESET_PATHS = ['/sw/cwc-integ/clic/session-data',
+               '/sw/cwc-integ/hms/bioagents/bioagents/images']
+MAX_RECYCLES = int(environ.get('CWC_MAX_RECYCLES', 20))
+
+
 app = Flask(__name__)
 app.config["MONGO_URI"] = 'mongodb://localhost:27017/myDatabase'
 app.config['SECRET_KEY'] = 'dev_key'
+# Not Flask's default name, which the dialogues behind the proxy may use.
+app.config['SESSION_COOKIE_NAME'] = 'cwc_service_session'
 mongo = PyMongo(app)
 Bootstrap(app)
+# Containers used to be tracked in this file, they are now kept in the
+# containers collection and the file is only read to import old entries.
 MY_CONTAINER_LIST = 'cwc_service_containers.json'
 TIME_FMT = '%Y%m%d%H%M%S'
 DAY = 86400  # a day in seconds.
@@ -47,98 +127,178 @@ if LOGS_LOCAL_DIR == HERE:
                 'default: %s' % HERE)
 
 
-def _load_id_dict():
+# The docker hosts sessions are placed on, see docker_hosts.py. Containers
+# registered before there were several hosts are on the first one.
+HOSTS = docker_hosts.load_hosts(MAX_SESSIONS)
+DEFAULT_HOST = next(iter(HOSTS))
+
+
+def get_docker_client(host=DEFAULT_HOST):
+    """Get the docker client of a host, shared by the threads of a process."""
+    return docker_hosts.get_client(HOSTS[host])
+
+
+def _get_host(record):
+    return record.get('host', DEFAULT_HOST)
+
+
+def _import_legacy_registry():
+    """Move containers from the old json registry file into the database."""
     if not path.exists(MY_CONTAINER_LIST):
-        return {}
-    id_dict = {}
+        return
     with open(MY_CONTAINER_LIST, 'r') as f:
         id_dict_strs = json.load(f)
     for id_val, data in id_dict_strs.items():
-        for key, val in data.items():
-            if key == 'date':
-                data[key] = datetime.strptime(val, TIME_FMT)
-        id_dict[id_val] = data
-    return id_dict
-
-
-def _dump_id_dict(id_dict):
-    json_dict = {}
-    for id_val, data in id_dict.items():
-        json_data = data.copy()
-        for key, val in data.items():
-            if key == 'date':
-                json_data[key] = val.strftime(TIME_FMT)
-        json_dict[id_val] = json_data
-    with open(MY_CONTAINER_LIST, 'w') as f:
-        json.dump(json_dict, f)
-    return
+        data['date'] = datetime.strptime(data['date'], TIME_FMT)
+        data['_id'] = id_val
+        data.setdefault('host', DEFAULT_HOST)
+        mongo.db.containers.replace_one({'_id': id_val}, data, upsert=True)
+    logger.info("Imported %d containers from %s."
+                % (len(id_dict_strs), MY_CONTAINER_LIST))
+    os.rename(MY_CONTAINER_LIST, MY_CONTAINER_LIST + '.imported')
+
+
+def _add_my_container(cont_id, interface, port, warm=False, cores=None,
+                      host=DEFAULT_HOST, address=None, footprint=None):
+    """Register a new container."""
+    logger.info("Adding %s to list of my containers." % cont_id)
+    try:
+        mongo.db.containers.insert_one({'_id': cont_id,
+                                        'host': host,
+                                        'interface': interface,
+                                        'date': datetime.utcnow(),
+                                        'port': port,
+                                        'address': address,
+                                        'warm': warm,
+                                        'cores': cores,
+                                        'footprint': footprint})
+    except DuplicateKeyError:
+        logger.info("This container was already registered.")
+        return False
+    return True
 
 
-def _add_my_container(cont_id, interface):
-    """Update the json with a new container."""
-    id_dict = _load_id_dict()
+def _get_upstream(record):
+    """Get the address and port the service reaches a container at."""
+    # Containers that don't publish a port are reached on the docker network.
+    if record.get('address'):
+        return (record['address'],
+                INTERFACES[record['interface']]['expose_port'])
+    return (docker_hosts.get_internal_address(HOSTS[_get_host(record)]),
+            record['port'])
 
-    if cont_id not in id_dict.keys():
-        logger.info("Adding %s to list of my containers." % cont_id)
-        id_dict[cont_id] = {'interface': interface, 'date': datetime.utcnow()}
-        _dump_id_dict(id_dict)
-        success = True
-    else:
-        logger.info("This container was already registered.")
-        success = False
 
-    return success
+def _get_my_container(cont_id):
+    """Get the metadata of one of my containers, or None."""
+    return mongo.db.containers.find_one({'_id': cont_id})
+
+
+def _update_my_container(cont_id, **fields):
+    """Update the metadata of one of my containers."""
+    res = mongo.db.containers.update_one({'_id': cont_id}, {'$set': fields})
+    if not res.matched_count:
+        logger.info("This container isn't mine or doesn't exist.")
+        return False
+    return True
 
 
 def _pop_my_container(cont_id, pop=True):
-    """Update the json with the removal of a container."""
-    id_dict = _load_id_dict()
+    """Remove a container from the registry and return its metadata."""
+    if pop:
+        ret = mongo.db.containers.find_one_and_delete({'_id': cont_id})
+    else:
+        ret = mongo.db.containers.find_one({'_id': cont_id})
 
-    if cont_id not in id_dict.keys():
+    if ret is None:
         logger.info("This container isn't mine or doesn't exist.")
-        ret = None
     else:
-        if pop:
-            ret = id_dict.pop(cont_id)
-        else:
-            ret = id_dict.get(cont_id)
         logger.info("Removing %s from list of my containers which had "
                     "metadata: %s." % (cont_id, ret))
-        _dump_id_dict(id_dict)
 
     return ret
 
 
+def _record_session_end(record):
+    """Keep the duration of a finished session for estimating wait times."""
+    if record.get('warm'):
+        return
+    end = datetime.utcnow()
+    mongo.db.session_history.insert_one(
+        {'container_id': record['_id'], 'interface': record['interface'],
+         'start': record['date'], 'end': end,
+         'duration': (end - record['date']).total_seconds()})
+
+
+@metrics.CHECK_TIMERS_SECONDS.time()
+def _list_session_containers(host, **kwargs):
+    """Get the session containers of a host by id.
+
+    These are the labeled containers and the registered ones, which include
+    containers started before session containers were labeled.
+    """
+    client = get_docker_client(host)
+    conts = {cont.id: cont for cont in client.containers.list(
+        filters={'label': SESSION_LABEL}, **kwargs)}
+    unlabeled = [rec['_id'] for rec in
+                 mongo.db.containers.find({'host': host}, ['_id'])
+                 if rec['_id'] not in conts]
+    if unlabeled:
+        conts.update({cont.id: cont for cont in client.containers.list(
+            filters={'id': unlabeled}, **kwargs)})
+    return conts
+
+
 def _check_timers():
     """Look through the containers and stop any timed-out containers."""
     # The logs are utc time, and this generally avoids any time-zone issues.
     # Won't work in python 2.
     now = datetime.utcnow()
 
-    # This is not connected to the other dict instances deliberately. Do not
-    # try to make the dict shared, because the below for-loop could then have
-    # issues modifying an object while iterating over it.
-    id_dict = _load_id_dict()
-    logger.info("There are %d instances running." % len(id_dict))
+    # The records are read up front because timed-out containers are removed
+    # from the registry inside the loop. Warm containers are idle by design,
+    # they only start timing out once handed out.
+    records = list(mongo.db.containers.find({'warm': {'$ne': True}}))
+    logger.info("There are %d instances running." % len(records))
+
+    # Get the state of all the session containers in one call per host.
+    conts = {}
+    for host in HOSTS:
+        conts.update(_list_session_containers(host, all=True, sparse=True))
 
     # Go through all the containers...
-    client = docker.from_env()
-    for cont_id, data in id_dict.items():
+    for data in records:
+        cont_id = data['_id']
         start_date = data['date']
         logger.info("Examining %s" % cont_id)
 
-        # Grab the date from the latest SPG log entry.
-        cont = client.containers.get(cont_id)
-        cont_logs = cont.logs()
+        # Catch containers that went down without us seeing the event.
+        cont = conts.get(cont_id)
+        if cont is None or cont.status != 'running':
+            logger.info("Container %s is not running." % cont_id)
+            _on_container_exit(cont_id)
+            continue
+
+        # Grab the date from the latest SPG log entry. Only the output since
+        # the previous check is fetched, the latest date found so far is
+        # kept in the registry along with where we stopped reading.
+        log_cursor = time.time()
+        if data.get('log_cursor'):
+            cont_logs = cont.logs(since=data['log_cursor'], until=log_cursor)
+        else:
+            cont_logs = cont.logs(until=log_cursor)
         date_strings = re.findall('SPG:\s+;;\s+\[(.*?)\]',
                                   cont_logs.decode('utf-8'))
         if date_strings:
             latest_log_date = datetime.strptime(date_strings[-1],
                                                 '%m/%d/%Y %H:%M:%S')
+        elif data.get('last_log_date'):
+            latest_log_date = data['last_log_date']
         else:
             logger.info("WARNING: Did not find any date strings in container "
                         "logs for %s." % cont_id)
             latest_log_date = start_date
+        _update_my_container(cont_id, log_cursor=log_cursor,
+                             last_log_date=latest_log_date)
 
         # Check both whether the logs have been silent for more than a day
         # (neglect) or whether the session has been running for more than 5
@@ -148,68 +308,410 @@ def _check_timers():
         if log_stalled > 2*HOUR:
             logger.info("Container %s timed out after %ds of empty logs."
                         % (cont_id, log_stalled))
-            _stop_container(cont_id)
+            metrics.SESSION_TIMEOUTS.labels('idle').inc()
+            enqueue_teardown(cont_id)
         elif total_dur > DAY/2:
             logger.info("Container %s timed out after %d seconds of running."
                   % (cont_id, total_dur))
-            _stop_container(cont_id)
+            metrics.SESSION_TIMEOUTS.labels('duration').inc()
+            enqueue_teardown(cont_id)
     return
 
 
-def get_increment_port():
-    port_json = mongo.db.ports.find_one()
-    if port_json is None:
-        port = 8000
-        mongo.db.ports.insert_one({'port': port})
-    else:
+# The host ports handed out to containers, e.g. "8000-8999". Free ports are
+# kept as one document per host and port in the free_ports collection.
+PORT_RANGE = tuple(int(p) for p in
+                   environ.get('CWC_PORT_RANGE', '8000-8999').split('-'))
+
+
+def _port_in_use(port):
+    """Return True if something on this host is already bound to the port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('0.0.0.0', port))
+    except OSError:
+        return True
+    finally:
+        sock.close()
+    return False
+
+
+def allocate_port(host=DEFAULT_HOST):
+    """Take a free port of the given host from the pool."""
+    # Ports taken by something outside the service are dropped from the
+    # pool, they come back when the pool is reseeded. Only the ports of this
+    # machine can be checked directly.
+    check = docker_hosts.is_local(HOSTS[host])
+    for _ in range(10):
+        port_json = mongo.db.free_ports.find_one_and_delete({'host': host})
+        if port_json is None:
+            raise NoFreePorts()
         port = port_json['port']
-        mongo.db.ports.update_one({'port': port}, {'$set': {'port': port + 1}})
-        port += 1
-    return port
+        if not check or not _port_in_use(port):
+            return port
+        logger.warning('Port %d is in use, dropping it from the pool.' % port)
+    raise NoFreePorts()
 
 
-def get_num_sessions():
-    sessions_json = mongo.db.sessions.find_one()
-    if not sessions_json:
-        return 0
-    num_sessions = sessions_json['num_sessions']
-    return num_sessions
+def release_port(port, host=DEFAULT_HOST):
+    """Give a port of the given host back to the pool."""
+    if port is None or not PORT_RANGE[0] <= port <= PORT_RANGE[1]:
+        return
+    try:
+        mongo.db.free_ports.insert_one({'_id': '%s:%d' % (host, port),
+                                        'host': host, 'port': port})
+    except DuplicateKeyError:
+        logger.warning('Port %d was released twice.' % port)
+
+
+def _seed_port_pool(host):
+    """Fill the pool with the host's ports that docker isn't using."""
+    client = get_docker_client(host)
+    used = set()
+    for cont in client.containers.list(sparse=True):
+        used |= {p['PublicPort'] for p in cont.attrs.get('Ports', [])
+                 if 'PublicPort' in p}
+    mongo.db.free_ports.delete_many({'host': host})
+    free = [{'_id': '%s:%d' % (host, port), 'host': host, 'port': port}
+            for port in range(PORT_RANGE[0], PORT_RANGE[1] + 1)
+            if port not in used]
+    if free:
+        mongo.db.free_ports.insert_many(free)
+    logger.info('Port pool of %s has %d free ports, %d in use.'
+                % (host, len(free), len(used)))
+
+
+# The resources each interface's containers may use: mem_limit in bytes,
+# cpus as a CPU quota, and the number of cores to dedicate to a container
+# (0 to let it run on any core). Can be overridden with a json dict in
+# CWC_RESOURCE_PROFILES, e.g. '{"SBGN": {"cores": 2}}'.
+RESOURCE_PROFILES = {
+    'CLIC': {'mem_limit': 4 * 1024**3, 'cpus': 2.0, 'cores': 0},
+    'SBGN': {'mem_limit': 6 * 1024**3, 'cpus': 3.0, 'cores': 0},
+}
+for _app_name, _profile in \
+        json.loads(environ.get('CWC_RESOURCE_PROFILES', '{}')).items():
+    RESOURCE_PROFILES[_app_name].update(_profile)
+# The number of cores, starting from core 0, that are never dedicated to a
+# container, so that the service and the system always have room.
+RESERVED_CORES = int(environ.get('CWC_RESERVED_CORES', 1))
+
+
+def allocate_cores(num_cores, host=DEFAULT_HOST):
+    """Take the given number of free cores of a host, return them."""
+    cores = []
+    for _ in range(num_cores):
+        core_json = mongo.db.free_cores.find_one_and_delete({'host': host})
+        if core_json is None:
+            release_cores(cores, host)
+            raise InsufficientResources()
+        cores.append(core_json['core'])
+    return sorted(cores)
+
+
+def release_cores(cores, host=DEFAULT_HOST):
+    """Give dedicated cores of a host back to the pool."""
+    for core in cores or []:
+        try:
+            mongo.db.free_cores.insert_one({'_id': '%s:%d' % (host, core),
+                                            'host': host, 'core': core})
+        except DuplicateKeyError:
+            logger.warning('Core %d was released twice.' % core)
+
+
+def _seed_core_pool(host):
+    """Fill the pool with every core of the host that can be dedicated."""
+    num_cpus = get_docker_client(host).info()['NCPU']
+    mongo.db.free_cores.delete_many({'host': host})
+    cores = [{'_id': '%s:%d' % (host, core), 'host': host, 'core': core}
+             for core in range(RESERVED_CORES, num_cpus)]
+    if cores:
+        mongo.db.free_cores.insert_many(cores)
+
+
+# There is a session counter for each host, a single document with the host
+# name as id, so that it can be updated atomically, in one round trip, from
+# any number of workers. It also holds the CPUs (cpu) and bytes of memory
+# (mem) committed to the sessions of the host, see can_admit.
+def _get_session_counts():
+    """Get the number of sessions on each host."""
+    counts = {host: 0 for host in HOSTS}
+    for sessions_json in mongo.db.sessions.find({'_id': {'$in': list(HOSTS)}}):
+        counts[sessions_json['_id']] = sessions_json['num_sessions']
+    return counts
 
 
-def increment_sessions():
-    sessions_json = mongo.db.sessions.find_one()
-    if sessions_json is None:
-        reset_sessions()
-    num_sessions = sessions_json['num_sessions']
-    if num_sessions == MAX_SESSIONS:
+def get_num_sessions():
+    return sum(_get_session_counts().values())
+
+
+def increment_sessions(host=DEFAULT_HOST, footprint=None):
+    # The filter only matches while there is room, so the limit is enforced
+    # by the database. When it doesn't match, the upsert tries to create a
+    # second document with the same id, which fails if the counter exists.
+    query = {'_id': host,
+             'num_sessions': {'$lt': HOSTS[host]['max_sessions']}}
+    inc = {'num_sessions': 1}
+    if footprint is not None:
+        inc.update(footprint)
+        if ADMISSION_CONTROL:
+            # The footprint is committed in the same step as the slot, so
+            # sessions started at the same time can't all fit in the room
+            # that is left for one.
+            for key, limit in _get_admission_limits(host).items():
+                query[key] = {'$not': {'$gt': limit - footprint[key]}}
+    try:
+        sessions_json = mongo.db.sessions.find_one_and_update(
+            query, {'$inc': inc}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
         raise SessionLimitExceeded()
-    mongo.db.sessions.update_one({'num_sessions': num_sessions},
-                                 {'$set': {'num_sessions': num_sessions + 1}})
-    return num_sessions + 1
+    return sessions_json['num_sessions']
 
 
-def decrement_sessions():
-    sessions_json = mongo.db.sessions.find_one()
+def decrement_sessions(host=DEFAULT_HOST, footprint=None):
+    inc = {'num_sessions': -1}
+    for key, amount in (footprint or {}).items():
+        inc[key] = -amount
+    sessions_json = mongo.db.sessions.find_one_and_update(
+        {'_id': host, 'num_sessions': {'$gt': 0}}, {'$inc': inc},
+        return_document=ReturnDocument.AFTER)
     if sessions_json is None:
-        reset_sessions()
-    num_sessions = sessions_json['num_sessions']
-    mongo.db.sessions.update_one({'num_sessions': num_sessions},
-                                 {'$set': {'num_sessions': num_sessions - 1}})
-    return num_sessions - 1
+        logger.warning('Session count of %s is already at zero.' % host)
+        return 0
+    return sessions_json['num_sessions']
+
+
+# The footprints of the interfaces start from these defaults and then follow
+# what the containers actually use.
+# Fraction of the host's CPUs and memory that is kept free.
+HOST_HEADROOM = float(environ.get('CWC_HOST_HEADROOM', 0.1))
+GB = 1024**3
+DEFAULT_FOOTPRINTS = {
+    'CLIC': {'cpu': 1.0, 'mem': 2*GB},
+    'SBGN': {'cpu': 1.5, 'mem': 3*GB},
+}
+# Measured footprints are scaled up by this much to leave room for peaks.
+FOOTPRINT_MARGIN = 1.25
+# The weight of a new sample in the moving average of the footprints.
+FOOTPRINT_ALPHA = 0.2
+# Host use sampled by the monitor is ignored once it is this many seconds
+# old.
+HOST_USAGE_MAX_AGE = 300
+_host_capacity = {}
+
+
+def _get_host_capacity(host):
+    """Get the number of CPUs and the bytes of memory of a docker host."""
+    if host not in _host_capacity:
+        info = get_docker_client(host).info()
+        _host_capacity[host] = {'cpu': info['NCPU'], 'mem': info['MemTotal']}
+    return _host_capacity[host]
+
+
+def _get_available_memory():
+    """Get the bytes of memory the host can still hand out."""
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _get_host_usage(host):
+    """Get the CPUs and bytes of memory in use on a host, or None.
+
+    This machine is measured directly, other hosts through the docker stats
+    of all their containers, as last sampled by the monitor.
+    """
+    if docker_hosts.is_local(HOSTS[host]):
+        return {'cpu': os.getloadavg()[0],
+                'mem': _get_host_capacity(host)['mem'] -
+                _get_available_memory()}
+    cutoff = datetime.utcnow() - timedelta(seconds=HOST_USAGE_MAX_AGE)
+    return mongo.db.host_usage.find_one({'_id': host,
+                                         'date': {'$gte': cutoff}})
+
+
+def _get_footprints():
+    """Get the expected CPU and memory use of a session of each interface."""
+    footprints = {app_name: fp.copy()
+                  for app_name, fp in DEFAULT_FOOTPRINTS.items()}
+    for measured in mongo.db.footprints.find():
+        footprints[measured['_id']] = \
+            {'cpu': measured['cpu'] * FOOTPRINT_MARGIN,
+             'mem': measured['mem'] * FOOTPRINT_MARGIN}
+    return footprints
+
+
+def _get_admission_limits(host):
+    """Get the CPUs and bytes of memory the sessions of a host can use."""
+    return {key: amount * (1 - HOST_HEADROOM)
+            for key, amount in _get_host_capacity(host).items()}
+
+
+def can_admit(app_name, host=DEFAULT_HOST):
+    """Return True if the host has room for another session."""
+    needed = _get_footprints()[app_name]
+    # What the sessions are expected to use, including the ones that are
+    # still starting and don't use much yet, as committed with their slots.
+    counter = mongo.db.sessions.find_one({'_id': host}) or {}
+    # What is actually in use, by the sessions or anything else.
+    used = _get_host_usage(host) or {}
+    for key, limit in _get_admission_limits(host).items():
+        if counter.get(key, 0) + needed[key] > limit:
+            logger.info('Not enough %s on %s for another %s session.'
+                        % (key, host, app_name))
+            return False
+        if key in used and used[key] + needed[key] > limit:
+            logger.info('Too much %s in use on %s for another %s session.'
+                        % (key, host, app_name))
+            return False
+    return True
+
+
+def choose_hosts(app_name):
+    """Get the hosts with room for a session, in order of preference."""
+    loads = {}
+    for host, num_sessions in _get_session_counts().items():
+        max_sessions = HOSTS[host]['max_sessions']
+        if num_sessions >= max_sessions:
+            continue
+        if ADMISSION_CONTROL and not can_admit(app_name, host):
+            continue
+        loads[host] = num_sessions / max_sessions
+    return docker_hosts.rank_hosts(loads)
+
+
+def has_capacity(app_name):
+    """Return True if a new session of the given interface can be started."""
+    return bool(choose_hosts(app_name))
+
+
+def _get_container_usage(cont):
+    """Get the CPUs and bytes of memory a container is using."""
+    stats = cont.stats(stream=False)
+    cpu, pre_cpu = stats['cpu_stats'], stats['precpu_stats']
+    cpu_delta = (cpu['cpu_usage']['total_usage'] -
+                 pre_cpu['cpu_usage']['total_usage'])
+    sys_delta = (cpu.get('system_cpu_usage', 0) -
+                 pre_cpu.get('system_cpu_usage', 0))
+    num_cpus = cpu.get('online_cpus') or \
+        len(cpu['cpu_usage'].get('percpu_usage') or [1])
+    cpus = cpu_delta / sys_delta * num_cpus if sys_delta > 0 else 0.0
+    # The page cache can be reclaimed, so it doesn't count.
+    mem = stats['memory_stats']
+    mem_stats = mem.get('stats', {})
+    cache = mem_stats.get('cache', mem_stats.get('inactive_file', 0))
+    return cpus, mem.get('usage', 0) - cache
+
+
+def sample_footprints():
+    """Update the footprint of each interface from the docker stats API.
+
+    The use of all the containers of each host is also kept, for the hosts
+    whose use can't be measured directly.
+    """
+    conts, hosts = [], []
+    for host in HOSTS:
+        host_conts = get_docker_client(host).containers.list(sparse=True)
+        conts += host_conts
+        hosts += [host] * len(host_conts)
+    if not conts:
+        return
+    # Getting the stats of a container takes a couple of seconds.
+    with ThreadPoolExecutor(
+            max_workers=min(len(conts), FOOTPRINT_THREADS)) as executor:
+        usages = list(executor.map(_get_container_usage, conts))
+    for host in HOSTS:
+        host_usages = [usage for usage, cont_host in zip(usages, hosts)
+                       if cont_host == host]
+        mongo.db.host_usage.replace_one(
+            {'_id': host}, {'cpu': sum(u[0] for u in host_usages),
+                            'mem': sum(u[1] for u in host_usages),
+                            'date': datetime.utcnow()}, upsert=True)
+    # Idle warm containers would pull the footprints down.
+    warm = {rec['_id'] for rec in mongo.db.containers.find({'warm': True},
+                                                           ['_id'])}
+    by_interface = {}
+    for cont, usage in zip(conts, usages):
+        app_name = (cont.attrs.get('Labels') or {}).get(SESSION_LABEL)
+        if app_name is None or cont.id in warm:
+            continue
+        by_interface.setdefault(app_name, []).append(usage)
+    for app_name, samples in by_interface.items():
+        cpu = sum(u[0] for u in samples) / len(samples)
+        mem = sum(u[1] for u in samples) / len(samples)
+        old = mongo.db.footprints.find_one({'_id': app_name})
+        if old is not None:
+            cpu = FOOTPRINT_ALPHA * cpu + (1 - FOOTPRINT_ALPHA) * old['cpu']
+            mem = FOOTPRINT_ALPHA * mem + (1 - FOOTPRINT_ALPHA) * old['mem']
+        mongo.db.footprints.replace_one({'_id': app_name},
+                                        {'cpu': cpu, 'mem': mem},
+                                        upsert=True)
+        logger.info('%s sessions use %.2f CPUs and %.2f GB on average.'
+                    % (app_name, cpu, mem / GB))
+
+
+# Used launch tokens and finished teardown jobs are forgotten after this many
+# seconds.
+TOKEN_TTL = DAY
+TEARDOWN_JOB_TTL = DAY
+
+# The most sessions, running or on their way, a user (by email, or by name
+# without one) and a client address may have, and the most launches they may
+# make in LAUNCH_RATE_WINDOW seconds, so that nobody takes every slot. 0 means
+# no limit.
+MAX_SESSIONS_PER_USER = int(environ.get('CWC_MAX_SESSIONS_PER_USER', 2))
+MAX_SESSIONS_PER_IP = int(environ.get('CWC_MAX_SESSIONS_PER_IP', 4))
+MAX_LAUNCHES_PER_USER = int(environ.get('CWC_MAX_LAUNCHES_PER_USER', 10))
+MAX_LAUNCHES_PER_IP = int(environ.get('CWC_MAX_LAUNCHES_PER_IP', 20))
+LAUNCH_RATE_WINDOW = HOUR
+# The addresses of the proxies (nginx) whose X-Forwarded-For is trusted, comma
+# separated. The quotas per client address are only applied with one, since
+# behind a proxy that doesn't set the header every user has its address.
+TRUSTED_PROXIES = [addr.strip() for addr in
+                   environ.get('CWC_TRUSTED_PROXIES', '').split(',')
+                   if addr.strip()]
+
+
+def _ensure_indexes():
+    """Create the indexes used for lookups and for expiring old documents."""
+    # Tokens stored before they had a date would never expire.
+    mongo.db.tokens.delete_many({'date': {'$exists': False}})
+    mongo.db.tokens.create_index('token', unique=True)
+    mongo.db.tokens.create_index('date', expireAfterSeconds=TOKEN_TTL)
+    mongo.db.containers.create_index('host')
+    mongo.db.free_ports.create_index('host')
+    mongo.db.free_cores.create_index('host')
+    mongo.db.session_history.create_index('end')
+    mongo.db.launch_queue.create_index([('status', 1), ('last_seen', 1)])
+    mongo.db.launch_queue.create_index('created', expireAfterSeconds=DAY)
+    mongo.db.containers.create_index('user_key')
+    mongo.db.containers.create_index('ip')
+    mongo.db.launch_queue.create_index('user_key')
+    mongo.db.launch_queue.create_index('ip')
+    mongo.db.launches.create_index('user_key')
+    mongo.db.launches.create_index('ip')
+    mongo.db.launches.create_index('date',
+                                   expireAfterSeconds=LAUNCH_RATE_WINDOW)
+    mongo.db.teardown_jobs.create_index('container_id')
+    mongo.db.teardown_jobs.create_index('queued',
+                                        expireAfterSeconds=TEARDOWN_JOB_TTL)
 
 
 def add_token(token):
-    mongo.db.tokens.insert_one({'token': token})
+    """Record a launch token, return False if it was already used."""
+    try:
+        mongo.db.tokens.insert_one({'token': token,
+                                    'date': datetime.utcnow()})
+    except DuplicateKeyError:
+        return False
+    return True
 
 
-def has_token(token):
-    tokens = mongo.db.tokens.find()
-    if tokens is None:
-        return False
-    for tok in tokens:
-        if tok['token'] == token:
-            return True
-    return False
+def remove_token(token):
+    mongo.db.tokens.delete_one({'token': token})
 
 
 def user_session_association(user, email, cont_id, cont_name, app_name,
@@ -225,47 +727,536 @@ def user_session_association(user, email, cont_id, cont_name, app_name,
                                            interface_port_number})
 
 
-def _launch_app(interface_port_num, app_name, extension=''):
+# Places reserved in a warm pool that were not filled within this many
+# seconds are given up, their process must have gone down.
+WARM_RESERVATION_TIMEOUT = 600
+
+
+def _reserve_warm_place(app_name):
+    """Reserve a place in the warm pool of an interface, return its id.
+
+    The places are numbered, so that the processes filling the pool at the
+    same time can't take more than its size. Returns None if the pool is
+    full.
+    """
+    for num in range(WARM_POOL_SIZE[app_name]):
+        place_id = '%s:%d' % (app_name, num)
+        try:
+            mongo.db.warm_pool.insert_one({'_id': place_id,
+                                           'interface': app_name,
+                                           'container_id': None,
+                                           'date': datetime.utcnow()})
+        except DuplicateKeyError:
+            continue
+        return place_id
+    return None
+
+
+def _fill_warm_place(place_id, cont_id, cont_name, host, port):
+    mongo.db.warm_pool.update_one({'_id': place_id},
+                                  {'$set': {'container_id': cont_id,
+                                            'container_name': cont_name,
+                                            'host': host,
+                                            'port': port,
+                                            'date': datetime.utcnow()}})
+
+
+def _start_warm_container(app_name, place_id):
+    """Start a container for the given interface in a place of the pool."""
+    try:
+        cont_id, cont_name, port, host = _run_container(
+            INTERFACES[app_name]['expose_port'], app_name, warm=True)
+    except SessionLimitExceeded:
+        mongo.db.warm_pool.delete_one({'_id': place_id})
+        logger.info('No free session slot to warm a %s container.'
+                    % app_name)
+        return False
+    except Exception:
+        mongo.db.warm_pool.delete_one({'_id': place_id})
+        raise
+    _fill_warm_place(place_id, cont_id, cont_name, host, port)
+    logger.info('Added %s to the %s warm pool.' % (cont_name, app_name))
+    return True
+
+
+def _fill_warm_pool():
+    """Start containers until each warm pool is at its configured size."""
+    # Free slots go to the users waiting in the queue first.
+    if _num_waiting():
+        return
+    cutoff = datetime.utcnow() - timedelta(seconds=WARM_RESERVATION_TIMEOUT)
+    mongo.db.warm_pool.delete_many({'container_id': None,
+                                    'date': {'$lt': cutoff}})
+    for app_name in WARM_POOL_SIZE:
+        while True:
+            place_id = _reserve_warm_place(app_name)
+            if place_id is None:
+                break
+            if not _start_warm_container(app_name, place_id):
+                return
+
+
+def _refill_warm_pool():
+    """Fill the warm pools, logging any error rather than raising it."""
+    try:
+        _fill_warm_pool()
+    except Exception as e:
+        logger.error("Failed to refill the warm pool.")
+        logger.exception(e)
+
+
+_refill_threads = []
+_refill_threads_lock = threading.Lock()
+
+
+def _refill_warm_pool_async():
+    """Top up the warm pools without blocking the current request."""
+    if any(WARM_POOL_SIZE.values()):
+        thread = threading.Thread(target=_refill_warm_pool, daemon=True)
+        thread.start()
+        # Kept so that the process can wait for them before it exits.
+        with _refill_threads_lock:
+            _refill_threads[:] = [t for t in _refill_threads if t.is_alive()]
+            _refill_threads.append(thread)
+
+
+def _claim_warm_container(app_name):
+    """Take the oldest warm container of the given interface, if any."""
+    warm = mongo.db.warm_pool.find_one_and_delete(
+        {'interface': app_name, 'container_id': {'$ne': None}},
+        sort=[('date', 1)])
+    if warm is None:
+        return None
+    # The session starts now, not when the container was warmed up, and its
+    # boot output doesn't need to be scanned for activity.
+    _update_my_container(warm['container_id'], date=datetime.utcnow(),
+                         warm=False, log_cursor=time.time())
+    logger.info('Handing out warm container %s.' % warm['container_name'])
+    return warm
+
+
+def _reset_container(cont):
+    """Bring a container back to a fresh state, return True if it worked."""
+    try:
+        if RESET_COMMAND:
+            res = cont.exec_run(RESET_COMMAND)
+        else:
+            res = cont.exec_run(['sh', '-c', 'rm -rf %s' % ' '.join(
+                '%s/*' % reset_path for reset_path in RESET_PATHS)])
+            if res.exit_code == 0:
+                cont.restart()
+    except Exception as e:
+        logger.warning('Could not reset %s: %s' % (cont.name, e))
+        return False
+    if res.exit_code != 0:
+        logger.warning('Resetting %s failed with exit code %s.'
+                       % (cont.name, res.exit_code))
+        return False
+    return True
+
+
+def _recycle_container(cont, record):
+    """Reset the container of an ended session and put it in the warm pool.
+
+    Return True if the container was recycled, in which case it keeps its
+    session slot, port and cores.
+    """
+    app_name = record['interface']
+    if record.get('recycled', 0) >= MAX_RECYCLES:
+        return False
+    # Free slots go to the users waiting in the queue first.
+    if _num_waiting():
+        return False
+    place_id = _reserve_warm_place(app_name)
+    if place_id is None:
+        return False
+    if not _reset_container(cont):
+        mongo.db.warm_pool.delete_one({'_id': place_id})
+        return False
+    host = _get_host(record)
+    # A restarted container may get another address on its network.
+    address = record.get('address')
+    if address and not RESET_COMMAND:
+        address = _get_container_address(cont)
+    _add_my_container(cont.id, app_name, record['port'], warm=True,
+                      cores=record.get('cores'), host=host, address=address,
+                      footprint=record.get('footprint'))
+    _update_my_container(cont.id, recycled=record.get('recycled', 0) + 1,
+                         reset_until=time.time())
+    _fill_warm_place(place_id, cont.id, cont.name, host, record['port'])
+    logger.info('Recycled %s into the %s warm pool.' % (cont.name, app_name))
+    return True
+
+
+def _get_logs_since(record):
+    """Get when the session of a recycled container started, or None."""
+    # The output of a recycled container also holds its earlier sessions.
+    return record['date'] if record.get('recycled') else None
+
+
+def _too_many_sessions():
+    # TODO: this should be part of the index page with buttons
+    # greyed out
+    return ('There are currently too many sessions, please come'
+            'back later or try the backup server at '
+            'http://34.230.33.149/.')
+
+
+def _get_dialogue_url(cont_id, host, port, extension, base_host):
+    """Get the address users reach a session container at."""
+    if ROUTING == 'proxy':
+        return base_host + ('/session/%s' % cont_id) + extension
+    address = HOSTS[host]['address']
+    base = 'http://' + address if address else base_host
+    return base + (':%d' % port + extension)
+
+
+def _start_session(app_name, user, email, base_host, user_key=None,
+                   ip=None):
+    """Start a session, return the arguments of the launch page."""
+    interface = INTERFACES[app_name]
+    time_out = interface['time_out']
+    # A warm container already holds its session slot, so it can be handed
+    # out even if we are at the session limit.
+    warm = _claim_warm_container(app_name)
+    if warm is not None:
+        port, cont_host = warm['port'], _get_host(warm)
+        cont_id, cont_name = warm['container_id'], warm['container_name']
+        # The container may still be booting if it was warmed up recently.
+        age = (datetime.utcnow() - warm['date']).total_seconds()
+        time_out = max(1, int(time_out - age))
+    else:
+        cont_id, cont_name, port, cont_host = \
+            _run_container(interface['expose_port'], app_name)
+    # Kept for the quotas of the user.
+    _update_my_container(cont_id, user_key=user_key, ip=ip)
+    _refill_warm_pool_async()
+    host = _get_dialogue_url(cont_id, cont_host, port,
+                             interface['extension'], base_host)
+    logger.info('Will redirect to address: %s' % host)
+    if user or email:
+        logger.info('Adding user info for user %s' % user)
+        user_session_association(user, email, cont_id, cont_name, app_name,
+                                 interface['extension'], port,
+                                 interface['expose_port'])
+    logger.info('Start redirecting %s interface.' % app_name)
+    return {'dialogue_url': host, 'manager_url': base_host,
+            'container_id': cont_id, 'time_out': time_out,
+            'container_name': cont_name, 'interface': app_name}
+
+
+# The longest the launch queue can get, and how long a ticket stays in the
+# queue after its page stopped asking for updates.
+MAX_QUEUE_LENGTH = int(environ.get('CWC_MAX_QUEUE_LENGTH', 20))
+QUEUE_TICKET_TIMEOUT = 60
+# Assumed session length in seconds until there are finished sessions.
+DEFAULT_SESSION_DURATION = HOUR/2
+
+
+def _waiting_filter():
+    """Match the tickets of users that are still waiting."""
+    cutoff = datetime.utcnow() - timedelta(seconds=QUEUE_TICKET_TIMEOUT)
+    return {'status': 'waiting', 'last_seen': {'$gte': cutoff}}
+
+
+def _num_waiting():
+    return mongo.db.launch_queue.count_documents(_waiting_filter())
+
+
+def _mean_session_duration():
+    """Get the mean duration of the most recent sessions."""
+    durations = [sess['duration'] for sess in
+                 mongo.db.session_history.find({}, ['duration'])
+                 .sort('end', -1).limit(100)]
+    if not durations:
+        return DEFAULT_SESSION_DURATION
+    return sum(durations) / len(durations)
+
+
+def _estimate_wait(position):
+    """Estimate the seconds until the ticket at the position gets a slot."""
+    mean_dur = _mean_session_duration()
+    now = datetime.utcnow()
+    # Running sessions are expected to last the mean duration, but any of
+    # them may end at any time once they are past it.
+    remaining = sorted(max(60, mean_dur - (now - rec['date']).total_seconds())
+                       for rec in mongo.db.containers.find(
+                           {'warm': {'$ne': True}}, ['date']))
+    if not remaining:
+        return 0
+    rounds, idx = divmod(position, len(remaining))
+    return int(remaining[idx] + rounds * mean_dur)
+
+
+def _get_client_ip():
+    """Get the address the user's request came from, or None if unknown."""
+    if not TRUSTED_PROXIES:
+        return None
+    # Anyone reaching the service directly could make the header up.
+    if request.remote_addr not in TRUSTED_PROXIES:
+        return request.remote_addr
+    # nginx adds the address it got the request from at the end, anything
+    # before it was sent by the client and can't be trusted.
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return request.remote_addr
+
+
+def _get_user_key(user, email):
+    """Get what identifies a user for the quotas, or None."""
+    if email.strip():
+        return email.strip().lower()
+    if user.strip():
+        return 'name:' + user.strip().lower()
+    return None
+
+
+def _check_quotas(user_key, ip):
+    """Return the quota the launches so far go over, or None.
+
+    The ticket and launch of the new launch have to be recorded already, so
+    that launches made at the same time can't all get past the quotas.
+    """
+    window_start = datetime.utcnow() - timedelta(seconds=LAUNCH_RATE_WINDOW)
+    # Tickets whose page stopped asking for updates are not counted, so
+    # that a ticket stuck for any reason doesn't lock its user out.
+    active_tickets = dict(_waiting_filter(), status={
+        '$in': ['pending', 'launching', 'waiting']})
+    for field, value, max_sessions, max_launches in [
+            ('user_key', user_key, MAX_SESSIONS_PER_USER,
+             MAX_LAUNCHES_PER_USER),
+            ('ip', ip, MAX_SESSIONS_PER_IP, MAX_LAUNCHES_PER_IP)]:
+        if value is None:
+            continue
+        if max_sessions:
+            num_active = mongo.db.containers.count_documents(
+                {field: value, 'warm': {'$ne': True}})
+            num_active += mongo.db.launch_queue.count_documents(
+                dict(active_tickets, **{field: value}))
+            if num_active > max_sessions:
+                return 'sessions'
+        if max_launches and mongo.db.launches.count_documents(
+                {field: value, 'date': {'$gte': window_start}}) \
+                > max_launches:
+            return 'launches'
+    return None
+
+
+def _over_quota(quota):
+    metrics.QUOTA_REJECTIONS.labels(quota).inc()
+    if quota == 'sessions':
+        msg = ('You already have as many dialogue sessions as allowed, '
+               'please end one before starting another.')
+    else:
+        msg = ('You have started too many dialogue sessions recently, '
+               'please come back later.')
+    return msg, 429
+
+
+def _create_ticket(app_name, user, email, base_host, user_key=None,
+                   ip=None):
+    """Make the ticket a launch is followed with, return its id."""
+    ticket = uuid.uuid4().hex
+    now = datetime.utcnow()
+    mongo.db.launches.insert_one({'_id': ticket, 'user_key': user_key,
+                                  'ip': ip, 'date': now})
+    mongo.db.launch_queue.insert_one({'_id': ticket,
+                                      'interface': app_name,
+                                      'user': user,
+                                      'email': email,
+                                      'user_key': user_key,
+                                      'ip': ip,
+                                      'base_host': base_host,
+                                      'status': 'pending',
+                                      'created': now,
+                                      'last_seen': now})
+    return ticket
+
+
+def _can_launch(ticket, position):
+    """Return True if the session of a ticket can be started right now."""
+    # A waiting user gets a warm container of their interface as soon as
+    # there is one, a free slot goes to the head of the queue.
+    has_warm = mongo.db.warm_pool.count_documents(
+        {'interface': ticket['interface'], 'container_id': {'$ne': None}},
+        limit=1)
+    return bool(has_warm) or (position == 0 and
+                              has_capacity(ticket['interface']))
+
+
+def _stop_idle_warm_container(app_name):
+    """Stop a warm container of another interface to free its slot.
+
+    Returns True if one was stopped.
+    """
+    warm = mongo.db.warm_pool.find_one_and_delete(
+        {'interface': {'$ne': app_name}, 'container_id': {'$ne': None}},
+        sort=[('date', 1)])
+    if warm is None:
+        return False
+    record = _pop_my_container(warm['container_id'])
+    if record is None:
+        return False
+    logger.info('Stopping warm container %s to make room for a %s session.'
+                % (warm['container_name'], app_name))
+    _stop_container(warm['container_id'], record=record)
+    return True
+
+
+def _admit_ticket(ticket_id):
+    """Start the session of a new ticket, or put it in the queue."""
+    try:
+        _try_admit_ticket(ticket_id)
+    except Exception as e:
+        logger.error('Failed to admit ticket %s.' % ticket_id)
+        logger.exception(e)
+        # Otherwise the launch page would wait for it forever.
+        mongo.db.launch_queue.update_one(
+            {'_id': ticket_id, 'status': 'pending'},
+            {'$set': {'status': 'failed'}})
+
+
+def _try_admit_ticket(ticket_id):
+    ticket = mongo.db.launch_queue.find_one({'_id': ticket_id})
+    if ticket is None:
+        return
+    # Nobody skips the queue, unless a warm container is waiting for them.
+    if _can_launch(ticket, _num_waiting()):
+        _launch_ticket(ticket_id, 'pending')
+        return
+    logger.info('Number of sessions: %d' % get_num_sessions())
+    if _num_waiting() >= MAX_QUEUE_LENGTH:
+        status = 'rejected'
+    else:
+        status = 'waiting'
+        logger.info('Queued %s launch as ticket %s.'
+                    % (ticket['interface'], ticket_id))
+    mongo.db.launch_queue.update_one(
+        {'_id': ticket_id, 'status': 'pending'},
+        {'$set': {'status': status, 'last_seen': datetime.utcnow()}})
+
+
+def _launch_ticket(ticket_id, from_status='waiting'):
+    """Start the session of a ticket, unless another thread already does."""
+    ticket = mongo.db.launch_queue.find_one_and_update(
+        {'_id': ticket_id, 'status': from_status},
+        {'$set': {'status': 'launching'}})
+    if ticket is None:
+        return
+    try:
+        session = _start_session(ticket['interface'], ticket['user'],
+                                 ticket['email'], ticket['base_host'],
+                                 ticket.get('user_key'), ticket.get('ip'))
+    except SessionLimitExceeded:
+        # Another worker took the slot, wait for the next one.
+        update = {'status': 'waiting', 'last_seen': datetime.utcnow()}
+    except Exception as e:
+        logger.error('Failed to launch ticket %s.' % ticket_id)
+        logger.exception(e)
+        update = {'status': 'failed'}
+    else:
+        update = {'status': 'launched', 'session': session}
+        metrics.LAUNCH_WAIT_SECONDS.labels(
+            ticket['interface'], str(from_status == 'waiting').lower()
+        ).observe((datetime.utcnow() - ticket['created']).total_seconds())
+    mongo.db.launch_queue.update_one({'_id': ticket_id}, {'$set': update})
+
+
+# The number of threads per worker that start sessions in the background,
+# so that requests don't wait for docker.
+LAUNCH_THREADS = int(environ.get('CWC_LAUNCH_THREADS', 4))
+
+
+@per_process
+def _get_launch_executor():
+    return ThreadPoolExecutor(max_workers=LAUNCH_THREADS)
+
+
+def _submit_launch(func, *args):
+    """Run a launch step in the background."""
+    def _run():
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error('Launch step %s%s failed.' % (func.__name__, args))
+            logger.exception(e)
+    _get_launch_executor().submit(_run)
+
+
+def _launch_app(app_name):
     user = request.form.get('user_name', '')
     email = request.form.get('user_email', '')
     if user or email:
         logger.info('User %s with email %s launched app' %
                     (user if user else '(username not provided)',
                      email if email else '(no email)'))
-    num_sessions = get_num_sessions()
-    if num_sessions >= MAX_SESSIONS:
-        logger.info('Number of sessions: %d' % num_sessions)
-        # TODO: this should be part of the index page with buttons
-        # greyed out
-        return ('There are currently too many sessions, please come'
-                'back later or try the backup server at '
-                'http://34.230.33.149/.')
-    # Here we check if the same token was already used to start a session
+    # Here we check if the same token was already used to start a session,
+    # adding it in the same step so that it can't be reused
     token = request.form['csrf_token']
-    if has_token(token):
+    if not add_token(token):
         # Flash could be nice but it gets placed on the home page instead of
         # the page with the dialogue for some reason
         # flash('You already have a session!')
         return ('', 204)
         #return 'You already have a running session, please stop it ' + \
         #    'and refresh the main page again to start another one.'
-    # We add the token to make sure it can't be reused
-    add_token(token)
-    port = get_increment_port()
+    user_key, ip = _get_user_key(user, email), _get_client_ip()
     base_host = 'http://' + str(request.host).split(':')[0]
-    host = base_host + (':%d' % port + extension)
-    logger.info('Will redirect to address: %s' % host)
-    cont_id, cont_name = _run_container(port, interface_port_num, app_name)
-    if user or email:
-        logger.info('Adding user info for user %s' % user)
-        user_session_association(user, email, cont_id, cont_name, app_name,
-                                 extension, port, interface_port_num)
-    logger.info('Start redirecting %s interface.' % app_name)
-    time_out = 30 if app_name == 'CLIC' else 60
-    return render_template('launch_dialogue.html', dialogue_url=host,
-                           manager_url=base_host, container_id=cont_id,
-                           time_out=time_out, container_name=cont_name,
-                           interface=app_name)
+    # The session is started in the background, the page follows the
+    # ticket until it is launched.
+    ticket = _create_ticket(app_name, user, email, base_host, user_key, ip)
+    quota = _check_quotas(user_key, ip)
+    if quota is not None:
+        logger.info('Launch by %s from %s is over the %s quota.'
+                    % (user_key, ip, quota))
+        mongo.db.launch_queue.delete_one({'_id': ticket})
+        mongo.db.launches.delete_one({'_id': ticket})
+        remove_token(token)
+        return _over_quota(quota)
+    _submit_launch(_admit_ticket, ticket)
+    return render_template('launch_queue.html', manager_url=base_host,
+                           ticket=ticket, interface=app_name)
+
+
+@app.route('/queue_status/<ticket_id>', methods=['GET'])
+def queue_status(ticket_id):
+    # Drop the tickets of users that left the queue page.
+    cutoff = _waiting_filter()['last_seen']['$gte']
+    mongo.db.launch_queue.delete_many({'status': 'waiting',
+                                       'last_seen': {'$lt': cutoff}})
+    ticket = mongo.db.launch_queue.find_one_and_update(
+        {'_id': ticket_id}, {'$set': {'last_seen': datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER)
+    if ticket is None:
+        return jsonify({'status': 'unknown'}), 404
+    if ticket['status'] == 'waiting':
+        query = _waiting_filter()
+        query['created'] = {'$lt': ticket['created']}
+        position = mongo.db.launch_queue.count_documents(query)
+        can_launch = _can_launch(ticket, position)
+        # Idle warm containers of the other interface don't keep the head of
+        # the queue waiting, the pools are filled again once it is empty.
+        if not can_launch and position == 0 and \
+                _stop_idle_warm_container(ticket['interface']):
+            can_launch = _can_launch(ticket, position)
+        if not can_launch:
+            return jsonify({'status': 'waiting', 'position': position + 1,
+                            'wait': _estimate_wait(position)})
+        _submit_launch(_launch_ticket, ticket_id)
+        return jsonify({'status': 'launching'})
+    if ticket['status'] == 'rejected':
+        return jsonify({'status': 'rejected',
+                        'message': _too_many_sessions()})
+    return jsonify({'status': ticket['status']})
+
+
+@app.route('/queue_session/<ticket_id>', methods=['GET'])
+def queue_session(ticket_id):
+    ticket = mongo.db.launch_queue.find_one({'_id': ticket_id})
+    if ticket is None or ticket['status'] != 'launched':
+        return 'No such session.', 404
+    return render_template('launch_dialogue.html', **ticket['session'])
 
 
 class ClicForm(Form):
@@ -292,100 +1283,871 @@ def hello():
 
 @app.route('/launch_clic', methods=['POST'])
 def launch_clic():
-    return _launch_app(8000, 'CLIC', '/clic/bio')
+    return _launch_app('CLIC')
 
 
 @app.route('/launch_sbgn', methods=['POST'])
 def launch_sbgn():
-    return _launch_app(3000, 'SBGN')
+    return _launch_app('SBGN')
+
+
+def _is_listening(address, port, extension=''):
+    """Return True if the dialogue answers on the given port and path."""
+    # Docker accepts connections on the mapped port right away and drops
+    # them until the container listens, so a real request is needed.
+    try:
+        urlopen('http://%s:%d%s' % (address, port, extension), timeout=1)
+    except HTTPError as e:
+        return e.code < 500
+    except Exception:
+        return False
+    return True
+
+
+@app.route('/session_ready/<cont_id>', methods=['GET'])
+def session_ready(cont_id):
+    record = _get_my_container(cont_id)
+    if record is None:
+        return jsonify({'ready': False, 'status': 'unknown'}), 404
+    client = get_docker_client(_get_host(record))
+    try:
+        cont = client.containers.get(cont_id)
+    except docker.errors.NotFound:
+        return jsonify({'ready': False, 'status': 'removed'})
+    if cont.status != 'running':
+        return jsonify({'ready': False, 'status': cont.status})
+    address, port = _get_upstream(record)
+    ready = _is_listening(address, port,
+                          INTERFACES[record['interface']]['extension'])
+    return jsonify({'ready': ready, 'status': cont.status})
+
+
+class _TunnelClosedResponse(Response):
+    """The response to a websocket request once its tunnel is closed.
+
+    The container's own response was already relayed to the client, whose
+    socket is shut down, so gunicorn has to close the connection without
+    writing a response, which it does quietly on StopIteration.
+    """
+    def __call__(self, environ, start_response):
+        raise StopIteration()
+
+
+def _proxy_session(cont_id, path):
+    """Forward the current request to the container of a session."""
+    record = _get_my_container(cont_id)
+    if record is None or record.get('warm'):
+        return 'No such session.', 404
+    address, port = _get_upstream(record)
+    prefix = '/session/%s' % cont_id
+    if request.query_string:
+        path += '?' + request.query_string.decode('latin-1')
+    # The service's own cookies are none of the container's business.
+    headers = session_proxy.get_request_headers(
+        request.environ, address, port, prefix,
+        strip_cookies=[app.config['SESSION_COOKIE_NAME'], PROXY_COOKIE])
+    if session_proxy.is_upgrade(request.environ):
+        if not session_proxy.tunnel(request.environ, address, port, path,
+                                    headers):
+            return 'Websockets need the service to run in gunicorn.', 501
+        return _TunnelClosedResponse()
+    try:
+        status, resp_headers, body = session_proxy.forward(
+            request.method, address, port, path, headers,
+            request.get_data(), prefix)
+    except Exception as e:
+        logger.warning('Could not reach %s: %s' % (cont_id, e))
+        return 'The session is not reachable.', 502
+    resp = Response(body, status=status, headers=resp_headers,
+                    direct_passthrough=True)
+    # Lets requests for absolute paths from the dialogue find the session.
+    resp.set_cookie(PROXY_COOKIE, cont_id)
+    return resp
+
+
+def proxy_session(cont_id, path):
+    return _proxy_session(cont_id, '/' + path)
+
+
+def proxy_absolute_path(path):
+    # The dialogues load some of their files from absolute paths, which
+    # don't go through /session/<container id>/.
+    cont_id = request.cookies.get(PROXY_COOKIE)
+    if cont_id is None:
+        return 'Not found.', 404
+    return _proxy_session(cont_id, '/' + path)
+
+
+def _get_metric_state():
+    """Get the current allocation state for the metrics endpoint."""
+    counts = _get_session_counts()
+    free_ports = {host: 0 for host in HOSTS}
+    free_cores = {host: 0 for host in HOSTS}
+    for coll, values in [(mongo.db.free_ports, free_ports),
+                         (mongo.db.free_cores, free_cores)]:
+        for group in coll.aggregate([{'$group': {'_id': '$host',
+                                                 'n': {'$sum': 1}}}]):
+            values[group['_id']] = group['n']
+    warm = {app_name: mongo.db.warm_pool.count_documents(
+        {'interface': app_name, 'container_id': {'$ne': None}})
+        for app_name in INTERFACES}
+    queue = {status: mongo.db.launch_queue.count_documents(
+        {'status': status}) for status in ['pending', 'launching']}
+    queue['waiting'] = _num_waiting()
+    return [
+        ('cwc_sessions', 'Session slots in use, warm containers included.',
+         'host', {host: counts.get(host, 0) for host in HOSTS}),
+        ('cwc_max_sessions', 'Session slots of each host.', 'host',
+         {host: HOSTS[host]['max_sessions'] for host in HOSTS}),
+        ('cwc_free_ports', 'Host ports that can be given to sessions.',
+         'host', free_ports),
+        ('cwc_free_cores', 'Cores that can be dedicated to sessions.',
+         'host', free_cores),
+        ('cwc_warm_containers', 'Booted containers waiting for a user.',
+         'interface', warm),
+        ('cwc_launch_tickets', 'Launch tickets not started yet.', 'status',
+         queue),
+    ]
+
+
+_state_collector = metrics.StateCollector(_get_metric_state)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.generate(_state_collector),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/end_session/<cont_id>', methods=['DELETE'])
 def stop_session(cont_id):
     logger.info("Request to end %s." % cont_id)
     assert cont_id, "Bad request. Need an id."
-    _stop_container(cont_id)
-    return 'Success!', 200
+    if _get_my_container(cont_id) is None and \
+            mongo.db.teardown_jobs.find_one(
+                {'container_id': cont_id,
+                 'status': {'$in': ['queued', 'running']}}) is None:
+        return 'No such session.', 404
+    job_id = enqueue_teardown(cont_id)
+    return jsonify({'job_id': job_id}), 202
+
+
+@app.route('/end_session_status/<job_id>', methods=['GET'])
+def stop_session_status(job_id):
+    job = mongo.db.teardown_jobs.find_one({'_id': job_id})
+    if job is None:
+        return jsonify({'status': 'unknown'}), 404
+    job['job_id'] = job.pop('_id')
+    return jsonify(job)
+
+
+class _ProxyPathConverter(PathConverter):
+    """A path that is not under one of the service's own routes."""
+
+
+# The proxy routes are added after all the others, so that the paths of the
+# service are known and answer 404 or 405 instead of being proxied.
+if ROUTING == 'proxy':
+    # Werkzeug only matches websocket upgrades against websocket routes.
+    for websocket, methods in [(False, PROXY_METHODS), (True, None)]:
+        app.add_url_rule('/session/<cont_id>/', view_func=proxy_session,
+                         defaults={'path': ''}, methods=methods,
+                         websocket=websocket)
+        app.add_url_rule('/session/<cont_id>/<path:path>',
+                         view_func=proxy_session, methods=methods,
+                         websocket=websocket)
+    _ProxyPathConverter.regex = '(?!(?:%s)(?:/|$))%s' % (
+        '|'.join(sorted(re.escape(prefix) for prefix in
+                        {rule.rule.split('/')[1]
+                         for rule in app.url_map.iter_rules()} - {''})),
+        PathConverter.regex)
+    app.url_map.converters['proxy_path'] = _ProxyPathConverter
+    for websocket, methods in [(False, PROXY_METHODS), (True, None)]:
+        app.add_url_rule('/<proxy_path:path>',
+                         view_func=proxy_absolute_path, methods=methods,
+                         websocket=websocket)
+
+
+# The number of threads per worker that stop containers in the background.
+TEARDOWN_THREADS = int(environ.get('CWC_TEARDOWN_THREADS', 2))
+# How often, in seconds, a process marks the teardown jobs it has as alive,
+# and after how long without it they are taken over by another process.
+TEARDOWN_HEARTBEAT = 30
+TEARDOWN_STALE = 5*TEARDOWN_HEARTBEAT
+_teardown_queue = queue.Queue()
+
+
+def _get_owner():
+    """Get what identifies this process as the owner of teardown jobs."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _run_teardown_job(job_id, cont_id, recycle=RECYCLE):
+    """Stop the container of a teardown job and record how it went."""
+    now = datetime.utcnow()
+    job = mongo.db.teardown_jobs.find_one_and_update(
+        {'_id': job_id},
+        {'$set': {'status': 'running', 'started': now,
+                  'owner': _get_owner(), 'heartbeat': now}},
+        return_document=ReturnDocument.AFTER)
+    update = {'status': 'done'}
+    try:
+        # The record is kept with the job once it is out of the registry, so
+        # that the job can be finished if this process goes down half way.
+        record = job.get('record')
+        if record is None:
+            record = _pop_my_container(cont_id)
+            assert record is not None, \
+                "Could not remove container because it is not my own."
+            mongo.db.teardown_jobs.update_one({'_id': job_id},
+                                              {'$set': {'record': record}})
+            _stop_container(cont_id, recycle=recycle, record=record)
+        elif _get_my_container(cont_id) is None:
+            _stop_container(cont_id, recycle=recycle, record=record)
+        # Otherwise the container was already put back in the warm pool.
+    except Exception as e:
+        logger.error("Failed to end the session of %s." % cont_id)
+        logger.exception(e)
+        update = {'status': 'failed', 'error': str(e)}
+    update['finished'] = datetime.utcnow()
+    mongo.db.teardown_jobs.update_one({'_id': job_id}, {'$set': update})
+
+
+def _run_teardown_jobs():
+    """Stop the containers of queued teardown jobs, one at a time."""
+    while True:
+        job_id, cont_id = _teardown_queue.get()
+        try:
+            _run_teardown_job(job_id, cont_id)
+        finally:
+            _teardown_queue.task_done()
+        _refill_warm_pool_async()
+
+
+def _beat_teardown_jobs():
+    """Keep marking the teardown jobs of this process as alive."""
+    while True:
+        time.sleep(TEARDOWN_HEARTBEAT)
+        try:
+            mongo.db.teardown_jobs.update_many(
+                {'owner': _get_owner(),
+                 'status': {'$in': ['queued', 'running']}},
+                {'$set': {'heartbeat': datetime.utcnow()}})
+        except Exception as e:
+            logger.exception(e)
+
+
+@per_process
+def _start_teardown_threads():
+    threading.Thread(target=_beat_teardown_jobs, daemon=True).start()
+    for _ in range(TEARDOWN_THREADS):
+        threading.Thread(target=_run_teardown_jobs, daemon=True).start()
+
+
+def _queue_teardown_job(job_id, cont_id):
+    _start_teardown_threads()
+    _teardown_queue.put((job_id, cont_id))
+
+
+def _stale_jobs_filter():
+    """Match the teardown jobs whose process went down."""
+    cutoff = datetime.utcnow() - timedelta(seconds=TEARDOWN_STALE)
+    return {'status': {'$in': ['queued', 'running']},
+            '$or': [{'heartbeat': {'$lt': cutoff}},
+                    {'heartbeat': {'$exists': False}}]}
 
 
-def _stop_container(cont_id, remove_record=True):
-    record = _pop_my_container(cont_id, pop=remove_record)
+def _take_over_teardown_job(job_id):
+    """Take a teardown job whose process went down, return it or None."""
+    return mongo.db.teardown_jobs.find_one_and_update(
+        dict(_stale_jobs_filter(), _id=job_id),
+        {'$set': {'status': 'queued', 'owner': _get_owner(),
+                  'heartbeat': datetime.utcnow()}})
+
+
+def enqueue_teardown(cont_id):
+    """Queue a container to be stopped in the background, return the job id."""
+    # Repeated requests for the same session share one job.
+    job = mongo.db.teardown_jobs.find_one(
+        {'container_id': cont_id, 'status': {'$in': ['queued', 'running']}})
+    if job is not None:
+        if _take_over_teardown_job(job['_id']) is not None:
+            logger.info("Taking over stale teardown job %s." % job['_id'])
+            _queue_teardown_job(job['_id'], cont_id)
+        return job['_id']
+    job_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    mongo.db.teardown_jobs.insert_one({'_id': job_id,
+                                       'container_id': cont_id,
+                                       'status': 'queued',
+                                       'queued': now,
+                                       'owner': _get_owner(),
+                                       'heartbeat': now})
+    _queue_teardown_job(job_id, cont_id)
+    logger.info("Queued teardown job %s for %s." % (job_id, cont_id))
+    return job_id
+
+
+def resume_stale_teardowns():
+    """Take over the teardown jobs of processes that went down."""
+    for job in mongo.db.teardown_jobs.find(_stale_jobs_filter()):
+        if _take_over_teardown_job(job['_id']) is not None:
+            logger.info("Taking over stale teardown job %s." % job['_id'])
+            _queue_teardown_job(job['_id'], job['container_id'])
+
+
+def finish_background_work():
+    """Wait for the sessions this process is starting or ending.
+
+    Called before a process exits, so that no container is left half
+    started or half stopped.
+    """
+    logger.info("Finishing the launches and teardowns of this process.")
+    _get_launch_executor().shutdown(wait=True)
+    _teardown_queue.join()
+    with _refill_threads_lock:
+        threads = list(_refill_threads)
+    for thread in threads:
+        thread.join()
+
+
+def _stop_container(cont_id, remove_record=True, recycle=False, record=None):
+    """Save the logs of a container and stop it, or recycle it.
+
+    If the record of the container is given, it is taken to be already out
+    of the registry.
+    """
+    start = time.time()
+    if record is None:
+        record = _pop_my_container(cont_id, pop=remove_record)
     if remove_record:
         assert record is not None, \
             "Could not remove container because it is not my own."
-    client = docker.from_env()
+    client = get_docker_client(_get_host(record))
     cont = client.containers.get(cont_id)
     logger.info("Got container %s, aka %s." % (cont.id, cont.name))
-    get_logs_for_container(cont, record['interface'], LOGS_LOCAL_DIR)
+    if record.get('warm'):
+        # Nobody used this container, so there are no logs worth keeping.
+        mongo.db.warm_pool.delete_one({'container_id': cont_id})
+    else:
+        _record_session_end(record)
+        get_logs_for_container(cont, record['interface'], LOGS_LOCAL_DIR,
+                               since=_get_logs_since(record))
+        if recycle and _recycle_container(cont, record):
+            metrics.STOP_CONTAINER_SECONDS.labels(
+                record['interface'], 'recycled').observe(time.time() - start)
+            return
     cont.stop()
     # cont.remove()
     logger.info("Container stopped.")
-    decrement_sessions()
+    _release_session(record)
+    metrics.STOP_CONTAINER_SECONDS.labels(
+        record['interface'], 'warm' if record.get('warm') else 'stopped'
+    ).observe(time.time() - start)
     return
 
 
-def _run_container(port, expose_port, app_name):
-    num_sessions = increment_sessions()
-    logger.info('We now have %d active sessions' % num_sessions)
-    client = docker.from_env()
-    startup = '/sw/cwc-integ/startup%s.sh' % ('_clic'
-                                              if app_name == 'CLIC'
-                                              else '')
-    cont = client.containers.run('%s:%s' % (DOCKER_IMAGE, DOCKER_TAG),
-                                 startup,
-                                 detach=True,
-                                 ports={('%d/tcp' % expose_port): port})
-    logger.info('Launched container %s exposing port %d via port %d'
-                % (cont, expose_port, port))
-    _add_my_container(cont.id, app_name)
-    return cont.id, cont.name
+def _release_session(record):
+    """Give back the session slot, port, cores and footprint of a container.
+    """
+    host = _get_host(record)
+    release_port(record.get('port'), host)
+    release_cores(record.get('cores'), host)
+    decrement_sessions(host, record.get('footprint'))
+
+
+def _get_startup(app_name):
+    return '/sw/cwc-integ/startup%s.sh' % ('_clic' if app_name == 'CLIC'
+                                           else '')
+
+
+def _get_image(client, app_name):
+    """Get the warm image of an interface if it is up to date, else the base.
+    """
+    base_name = '%s:%s' % (DOCKER_IMAGE, DOCKER_TAG)
+    warm_name = '%s:%s' % (DOCKER_IMAGE, WARM_IMAGE_TAG % app_name.lower())
+    try:
+        warm = client.images.get(warm_name)
+        base = client.images.get(base_name)
+    except docker.errors.ImageNotFound:
+        return base_name
+    if warm.labels.get(BASE_IMAGE_LABEL) != base.id:
+        logger.info('%s is older than %s, not using it.'
+                    % (warm_name, base_name))
+        return base_name
+    return warm_name
+
+
+def _boot_until_ready(image, app_name, host=DEFAULT_HOST, time_out=600):
+    """Start a container outside of any session and wait for its dialogue.
+
+    Returns the container, the seconds it took to be ready and the port it
+    publishes, which the caller has to release once the container is
+    removed.
+    """
+    interface = INTERFACES[app_name]
+    client = get_docker_client(host)
+    port = allocate_port(host)
+    try:
+        start = time.time()
+        cont = client.containers.run(
+            image, _get_startup(app_name), detach=True,
+            ports={('%d/tcp' % interface['expose_port']): port})
+    except Exception:
+        release_port(port, host)
+        raise
+    address = docker_hosts.get_internal_address(HOSTS[host])
+    while not _is_listening(address, port, interface['extension']):
+        if time.time() - start > time_out:
+            cont.stop()
+            cont.remove()
+            release_port(port, host)
+            raise TimeoutError('%s did not get ready within %ds.'
+                               % (image, time_out))
+        time.sleep(0.5)
+    return cont, time.time() - start, port
+
+
+def build_warm_image(app_name, host=DEFAULT_HOST):
+    """Boot a container of an interface and commit it as its warm image.
+
+    Note that a commit keeps the files of the container, such as resources
+    the bioagents download or unpack while booting, but not its processes,
+    so containers of the warm image still run the startup script.
+    """
+    base_name = '%s:%s' % (DOCKER_IMAGE, DOCKER_TAG)
+    base = get_docker_client(host).images.get(base_name)
+    cont, secs, port = _boot_until_ready(base_name, app_name, host)
+    logger.info('%s container ready after %.1fs, committing it.'
+                % (app_name, secs))
+    try:
+        cont.stop()
+        image = cont.commit(
+            repository=DOCKER_IMAGE,
+            tag=WARM_IMAGE_TAG % app_name.lower(),
+            changes=['LABEL %s=%s' % (BASE_IMAGE_LABEL, base.id)])
+    finally:
+        cont.remove()
+        release_port(port, host)
+    logger.info('Built %s:%s.' % (DOCKER_IMAGE,
+                                  WARM_IMAGE_TAG % app_name.lower()))
+    return image
+
+
+def benchmark_start(app_name, runs=3, host=DEFAULT_HOST):
+    """Compare the time to ready of containers of the base and warm images."""
+    client = get_docker_client(host)
+    images = {'cold': '%s:%s' % (DOCKER_IMAGE, DOCKER_TAG)}
+    warm_name = _get_image(client, app_name)
+    if warm_name != images['cold']:
+        images['warm'] = warm_name
+    else:
+        logger.info('There is no up to date warm image for %s.' % app_name)
+    results = {}
+    for kind, image in images.items():
+        times = []
+        for _ in range(runs):
+            cont, secs, port = _boot_until_ready(image, app_name, host)
+            cont.stop()
+            cont.remove()
+            release_port(port, host)
+            times.append(secs)
+        results[kind] = times
+        logger.info('%s %s start: mean %.1fs, min %.1fs, max %.1fs (%s).'
+                    % (app_name, kind, sum(times)/len(times), min(times),
+                       max(times), image))
+    return results
+
+
+def _get_container_address(cont):
+    """Get the address of a running container on its docker network."""
+    cont.reload()
+    settings = cont.attrs['NetworkSettings']
+    if settings.get('IPAddress'):
+        return settings['IPAddress']
+    for network in settings.get('Networks', {}).values():
+        if network.get('IPAddress'):
+            return network['IPAddress']
+    raise RuntimeError('Container %s has no network address.' % cont.name)
+
+
+def _run_container(expose_port, app_name, warm=False):
+    start = time.time()
+    # Take a slot on the preferred host that still has one, another worker
+    # may have taken the last slot of a host since it was chosen.
+    footprint = _get_footprints()[app_name]
+    for host in choose_hosts(app_name):
+        try:
+            num_sessions = increment_sessions(host, footprint)
+            break
+        except SessionLimitExceeded:
+            continue
+    else:
+        metrics.RUN_CONTAINER_FAILURES.labels(app_name, 'no_slot').inc()
+        if ADMISSION_CONTROL:
+            raise InsufficientResources()
+        raise SessionLimitExceeded()
+    logger.info('We now have %d active sessions on %s' % (num_sessions, host))
+    record = {'host': host, 'footprint': footprint}
+    profile = RESOURCE_PROFILES[app_name]
+    # The service reaches the containers of the local host on the docker
+    # network when it proxies the sessions, other hosts need a port.
+    publish = ROUTING != 'proxy' or not docker_hosts.is_local(HOSTS[host])
+    try:
+        record['port'] = port = allocate_port(host) if publish else None
+        record['cores'] = cores = allocate_cores(profile['cores'], host)
+    except SessionLimitExceeded:
+        logger.warning('There are no free ports or cores left.')
+        metrics.RUN_CONTAINER_FAILURES.labels(app_name, 'no_port').inc()
+        _release_session(record)
+        raise
+    limits = {'mem_limit': profile['mem_limit'],
+              'memswap_limit': profile['mem_limit'],
+              'nano_cpus': int(profile['cpus'] * 1e9)}
+    if cores:
+        limits['cpuset_cpus'] = ','.join(str(core) for core in cores)
+    if publish:
+        limits['ports'] = {('%d/tcp' % expose_port): port}
+    client = get_docker_client(host)
+    try:
+        cont = client.containers.run(_get_image(client, app_name),
+                                     _get_startup(app_name),
+                                     detach=True,
+                                     labels={SESSION_LABEL: app_name},
+                                     **limits)
+        address = None if publish else _get_container_address(cont)
+    except Exception:
+        # Give the slot back, otherwise it is lost until the next reset.
+        metrics.RUN_CONTAINER_FAILURES.labels(app_name, 'docker').inc()
+        _release_session(record)
+        raise
+    logger.info('Launched container %s on %s exposing port %d via %s'
+                % (cont, host, expose_port, address or 'port %d' % port))
+    _add_my_container(cont.id, app_name, port, warm=warm, cores=cores,
+                      host=host, address=address, footprint=footprint)
+    metrics.RUN_CONTAINER_SECONDS.labels(app_name, host).observe(
+        time.time() - start)
+    return cont.id, cont.name, port, host
 
 
 def reset_sessions():
     """Reset all the db sessions."""
     logger.info('Resetting sessions')
-    sessions_json = mongo.db.sessions.find_one()
-    if sessions_json is None:
-        mongo.db.sessions.insert_one({'num_sessions': 0})
-    else:
-        mongo.db.sessions.update_one({}, {'$set': {'num_sessions': 0}})
+    # Drop the counters of hosts that are gone.
+    mongo.db.sessions.delete_many({'_id': {'$nin': list(HOSTS)}})
+    # The old ever-growing port counter isn't used anymore.
+    mongo.db.ports.drop()
+    for host in HOSTS:
+        _seed_port_pool(host)
+        _seed_core_pool(host)
+        mongo.db.sessions.update_one({'_id': host},
+                                     {'$set': {'num_sessions': 0,
+                                               'cpu': 0.0, 'mem': 0.0}},
+                                     upsert=True)
+    mongo.db.warm_pool.delete_many({})
+    _import_legacy_registry()
+    _ensure_indexes()
+
+
+def _parse_cpuset(cpuset):
+    """Get the cores of a docker cpuset such as "1,3-4"."""
+    cores = []
+    for part in filter(None, (cpuset or '').split(',')):
+        first, _, last = part.partition('-')
+        cores += range(int(first), int(last or first) + 1)
+    return cores
+
+
+def _adopt_container(cont, host):
+    """Register a running session container the registry doesn't know."""
+    interface = cont.labels[SESSION_LABEL]
+    published = cont.ports.get('%d/tcp' % INTERFACES[interface]['expose_port'])
+    port = int(published[0]['HostPort']) if published else None
+    cores = _parse_cpuset(cont.attrs.get('HostConfig', {}).get('CpusetCpus'))
+    _add_my_container(cont.id, interface, port, cores=cores, host=host,
+                      address=None if port else _get_container_address(cont))
+    # The session started with the container, as far as anyone can tell.
+    _update_my_container(cont.id, date=datetime.strptime(
+        cont.attrs['Created'].split('.')[0], '%Y-%m-%dT%H:%M:%S'))
+    logger.info('Adopted %s container %s on %s.' % (interface, cont.name,
+                                                   host))
+
+
+def rebuild_sessions():
+    """Rebuild the session state from the containers that are running.
+
+    Unlike reset_sessions, this keeps the running sessions and warm
+    containers, so that the service can be restarted without ending them.
+    It has to run while no worker is serving requests.
+    """
+    logger.info('Rebuilding sessions from the running containers')
+    _import_legacy_registry()
+    _ensure_indexes()
+    mongo.db.containers.update_many({'host': {'$exists': False}},
+                                    {'$set': {'host': DEFAULT_HOST}})
+    mongo.db.sessions.delete_many({'_id': {'$nin': list(HOSTS)}})
+    mongo.db.ports.drop()
+    names = {}
+    for host in HOSTS:
+        running = _list_session_containers(host)
+        names.update({cont_id: cont.name for cont_id, cont in running.items()})
+        records = {rec['_id']: rec
+                   for rec in mongo.db.containers.find({'host': host})}
+        for cont_id, record in records.items():
+            if cont_id in running:
+                continue
+            logger.info('Container %s is not running anymore.' % cont_id)
+            _pop_my_container(cont_id)
+            mongo.db.warm_pool.delete_one({'container_id': cont_id})
+            if record.get('warm'):
+                continue
+            _record_session_end(record)
+            # Its logs are saved like those of any container that went down.
+            try:
+                cont = get_docker_client(host).containers.get(cont_id)
+                get_logs_for_container(cont, record['interface'],
+                                       LOGS_LOCAL_DIR,
+                                       since=_get_logs_since(record))
+            except Exception as e:
+                logger.error("Failed to save the logs of %s." % cont_id)
+                logger.exception(e)
+        for cont_id, cont in running.items():
+            if cont_id not in records:
+                _adopt_container(cont, host)
+
+        # Everything running on the host holds its slot, port and cores.
+        _seed_port_pool(host)
+        _seed_core_pool(host)
+        records = list(mongo.db.containers.find({'host': host}))
+        used_cores = ['%s:%d' % (host, core) for rec in records
+                      for core in rec.get('cores') or []]
+        mongo.db.free_cores.delete_many({'_id': {'$in': used_cores}})
+        # Containers registered before footprints were committed get the
+        # current footprint of their interface.
+        footprints = _get_footprints()
+        counter = {'num_sessions': len(records), 'cpu': 0.0, 'mem': 0.0}
+        for rec in records:
+            if rec.get('footprint') is None:
+                rec['footprint'] = footprints[rec['interface']]
+                _update_my_container(rec['_id'], footprint=rec['footprint'])
+            for key, amount in rec['footprint'].items():
+                counter[key] += amount
+        mongo.db.sessions.update_one({'_id': host}, {'$set': counter},
+                                     upsert=True)
+        logger.info('%s has %d sessions.' % (host, len(records)))
+
+    # Rebuild the warm pool from the warm containers, those it has no place
+    # for are stopped.
+    mongo.db.warm_pool.delete_many({})
+    for record in mongo.db.containers.find({'warm': True}):
+        place_id = _reserve_warm_place(record['interface'])
+        if place_id is None:
+            logger.info('No place in the warm pool for %s, stopping it.'
+                        % record['_id'])
+            _stop_container(record['_id'])
+            continue
+        _fill_warm_place(place_id, record['_id'], names[record['_id']],
+                         _get_host(record), record['port'])
+
+    # The threads that worked on these are gone with the old workers.
+    mongo.db.launch_queue.update_many(
+        {'status': {'$in': ['pending', 'launching']}},
+        {'$set': {'status': 'failed'}})
+    for job in mongo.db.teardown_jobs.find(
+            {'status': {'$in': ['queued', 'running']}}):
+        if _get_my_container(job['container_id']) is None and \
+                job.get('record') is None:
+            mongo.db.teardown_jobs.update_one(
+                {'_id': job['_id']},
+                {'$set': {'status': 'done', 'finished': datetime.utcnow()}})
+            continue
+        _run_teardown_job(job['_id'], job['container_id'], recycle=False)
+
+
+# The number of containers the cleanup stops at the same time.
+CLEANUP_THREADS = int(environ.get('CWC_CLEANUP_THREADS', 8))
+
+
+def _timed_stop_container(cont_id):
+    start = time.time()
+    _stop_container(cont_id)
+    return time.time() - start
 
 
-def cleanup():
+def cleanup(max_workers=CLEANUP_THREADS):
     """Stop all the currently running containers and remove."""
     logger.info("Starting cleanup.")
     print("+" + "-"*78 + "+")
     print("| %-76s |" % "Grabbing logs, stopping, and removing all docker containers...")
     print("| %-76s |" % "Please wait, as this may take a while.")
     print("+" + "-"*78 + "+")
-    id_dict = _load_id_dict()
-    num_conts = len(id_dict)
-    for i, (cont_id, start_date) in enumerate(id_dict.items()):
+    _import_legacy_registry()
+    cont_ids = [rec['_id'] for rec in mongo.db.containers.find({}, ['_id'])]
+    num_conts = len(cont_ids)
+    failed = []
+    # Each container's logs are pulled and uploaded independently, so the
+    # containers are handled in parallel.
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(_timed_stop_container, cont_id): cont_id
+                   for cont_id in cont_ids}
+        for i, future in enumerate(as_completed(futures)):
+            cont_id = futures[future]
+            try:
+                dur = future.result()
+                print("(%d/%d) Resolved %s in %.1fs."
+                      % (i+1, num_conts, cont_id, dur))
+            except Exception as e:
+                print("(%d/%d) Failed to resolve %s: %s"
+                      % (i+1, num_conts, cont_id, e))
+                logger.error("Failed to shut down the container: %s!"
+                             % cont_id)
+                logger.error("Reason:")
+                logger.exception(e)
+                failed.append(cont_id)
+    print("+" + "-"*78 + "+")
+    if failed:
+        print("| %-76s |" % ("Failed to shut down %d of %d containers:"
+                             % (len(failed), num_conts)))
+        for cont_id in failed:
+            print("| %-76s |" % cont_id[:76])
+    else:
+        print("| %-76s |" % "All done! Have a nice day! :)")
+    print("+" + "-"*78 + "+")
+    return failed
+
+
+# Containers that went down on their own, waiting for their logs to be saved.
+_exited_logs_queue = queue.Queue()
+
+
+def _on_container_exit(cont_id, event_time=None):
+    """Free the slot and port of a container that went down on its own."""
+    # A recycled container is restarted on purpose.
+    record = _get_my_container(cont_id)
+    if record is not None and event_time is not None and \
+            event_time <= record.get('reset_until', 0):
+        return
+    # Containers stopped by the service are removed from the registry before
+    # they are stopped, so only unexpected exits get this far.
+    record = _pop_my_container(cont_id)
+    if record is None:
+        return
+    logger.info("Container %s went down, freeing its session." % cont_id)
+    if record.get('warm'):
+        mongo.db.warm_pool.delete_one({'container_id': cont_id})
+    else:
+        _record_session_end(record)
+        _exited_logs_queue.put((cont_id, record['interface'],
+                                _get_host(record), _get_logs_since(record)))
+    _release_session(record)
+    _refill_warm_pool_async()
+
+
+def _save_exited_logs():
+    """Save the logs of containers that went down, one at a time."""
+    while True:
+        cont_id, interface, host, since = _exited_logs_queue.get()
         try:
-            print("(%d/%d) Resolving %s...." % (i+1, num_conts, cont_id))
-            _stop_container(cont_id)
+            cont = get_docker_client(host).containers.get(cont_id)
+            get_logs_for_container(cont, interface, LOGS_LOCAL_DIR,
+                                   since=since)
         except Exception as e:
-            logger.error("Failed to shut down the container: %s!" % cont_id)
-            logger.error("Reasion:")
+            logger.error("Failed to save the logs of %s." % cont_id)
             logger.exception(e)
-            logger.info("Continuing...")
-    print("+" + "-"*78 + "+")
-    print("| %-76s |" % "All done! Have a nice day! :)")
-    print("+" + "-"*78 + "+")
+        finally:
+            _exited_logs_queue.task_done()
+
+
+def watch_events(host=DEFAULT_HOST):
+    """Free sessions as soon as a host reports their container went down."""
+    # Events are read again from the last one seen after a reconnection, so
+    # that none are missed. Handling one twice does no harm.
+    since = int(time.time())
+    while True:
+        try:
+            client = get_docker_client(host)
+            events = client.events(decode=True, since=since, filters={
+                'type': 'container', 'label': SESSION_LABEL,
+                'event': ['die', 'stop', 'oom']})
+            for event in events:
+                since = event.get('time', since)
+                cont_id = event['Actor']['ID']
+                logger.info("Got %s event for %s."
+                            % (event['Action'], cont_id))
+                # A process can be killed for memory while the container
+                # itself keeps running, and a recycled container is
+                # restarted.
+                try:
+                    if client.containers.get(cont_id).status in \
+                            ('running', 'restarting'):
+                        continue
+                except docker.errors.NotFound:
+                    pass
+                _on_container_exit(cont_id, event.get('time'))
+        except Exception as e:
+            logger.error("Lost the docker event stream of %s, reconnecting."
+                         % host)
+            logger.exception(e)
+            time.sleep(5)
+
+
+# How often, in seconds, the monitor samples the resource use of containers.
+FOOTPRINT_INTERVAL = 60
+# The number of containers whose use is sampled at the same time.
+FOOTPRINT_THREADS = int(environ.get('CWC_FOOTPRINT_THREADS', 8))
+
+
+def _sample_footprints_periodically():
+    while True:
+        try:
+            sample_footprints()
+        except Exception as e:
+            logger.error("Failed to sample container resource use.")
+            logger.exception(e)
+        time.sleep(FOOTPRINT_INTERVAL)
+
+
+# Set when the monitor is asked to stop, which it then does between steps.
+_monitor_stopping = threading.Event()
+
+
+def _stop_monitor(signum, frame):
+    _monitor_stopping.set()
+
+
+def _run_monitor_steps(*steps):
+    """Run the given steps in turn, unless the monitor is asked to stop."""
+    for step in steps:
+        if _monitor_stopping.is_set():
+            return
+        step()
 
 
 def monitor():
     """Check session timers and clean up old session periodically."""
     logger.info("Monitor starting.")
+    # Let the monitor finish what it is doing when it is stopped or replaced.
+    signal.signal(signal.SIGTERM, _stop_monitor)
+    for host in HOSTS:
+        threading.Thread(target=watch_events, args=(host,),
+                         daemon=True).start()
+    threading.Thread(target=_save_exited_logs, daemon=True).start()
+    if ADMISSION_CONTROL:
+        threading.Thread(target=_sample_footprints_periodically,
+                         daemon=True).start()
     try:
-        while True:
-            time.sleep(60*15)  # every 15 minutes
+        _run_monitor_steps(resume_stale_teardowns, _refill_warm_pool)
+        while not _monitor_stopping.wait(60*15):  # every 15 minutes
             logger.info("Checking session in monitor...")
-            _check_timers()
+            _run_monitor_steps(_check_timers, resume_stale_teardowns,
+                               _refill_warm_pool)
             logger.info("Check complete. Waiting...")
+        logger.info("Monitor is closing.")
     except BaseException as e:
         logger.info("Monitor is closing with:")
         logger.exception(e)
+    finish_background_work()
+    _exited_logs_queue.join()
     return
 
 
@@ -393,12 +2155,26 @@ if __name__ == '__main__':
     from sys import argv
     if argv[1] == 'cleanup':
         logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
-        cleanup()
+        if len(argv) > 2:
+            cleanup(int(argv[2]))
+        else:
+            cleanup()
     elif argv[1] == 'monitor':
         logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
         monitor()
     elif argv[1] == 'reset':
         logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
         reset_sessions()
+    elif argv[1] == 'rebuild':
+        logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
+        rebuild_sessions()
+    elif argv[1] == 'build_warm':
+        logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
+        for app_name in argv[2:] or list(INTERFACES):
+            build_warm_image(app_name)
+    elif argv[1] == 'benchmark':
+        logging.basicConfig(level=logging.INFO, format=LOGGING_FMT)
+        for app_name in list(INTERFACES):
+            benchmark_start(app_name, int(argv[2]) if len(argv) > 2 else 3)
     else:
         app.run(host='0.0.0.0')
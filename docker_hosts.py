@@ -0,0 +1,83 @@
+"""The docker hosts that session containers can be placed on.
+
+The hosts are read from the CWC_DOCKER_HOSTS environment variable as a json
+list of dicts, for instance
+
+    [{"name": "a", "base_url": "tcp://10.0.0.5:2375", "address": "1.2.3.4",
+      "max_sessions": 8},
+     {"name": "b", "base_url": "fake://127.0.0.2?boot=5"}]
+
+where base_url is the address of the docker daemon (null for the local
+daemon set up in the environment, fake:// for an in-process fake daemon from
+fake_docker.py), address is where users reach the containers of the host
+(null for the address of the service itself) and max_sessions is the most
+sessions the host runs at the same time. If the variable is not set, the
+local docker daemon is the only host.
+"""
+import json
+import docker
+from os import environ
+from urllib.parse import urlparse
+from per_process import per_process
+
+import logging
+logger = logging.getLogger('docker-hosts')
+
+# The number of connections to a docker daemon each process keeps open.
+DOCKER_POOL_SIZE = int(environ.get('CWC_DOCKER_POOL_SIZE', 10))
+
+# How sessions are spread over the hosts: 'least_loaded' puts a session on
+# the host with the lowest share of its sessions in use, 'bin_packing' on the
+# fullest host that still has room, so that the other hosts can be let go.
+PLACEMENT = environ.get('CWC_PLACEMENT', 'least_loaded')
+
+def load_hosts(default_max_sessions):
+    """Get the configured hosts by name, in the order they were given."""
+    hosts = json.loads(environ.get('CWC_DOCKER_HOSTS', 'null')) or \
+        [{'name': 'local'}]
+    for host in hosts:
+        host.setdefault('base_url', None)
+        host.setdefault('address', None)
+        host.setdefault('max_sessions', default_max_sessions)
+    return {host['name']: host for host in hosts}
+
+
+def make_client(base_url):
+    """Make a docker client for the daemon at the given url."""
+    if base_url is None:
+        return docker.from_env(max_pool_size=DOCKER_POOL_SIZE)
+    if base_url.startswith('fake://'):
+        from fake_docker import FakeDockerClient
+        return FakeDockerClient.from_url(base_url)
+    return docker.DockerClient(base_url=base_url,
+                               max_pool_size=DOCKER_POOL_SIZE)
+
+
+_get_client = per_process(lambda name, base_url: make_client(base_url))
+
+
+def get_client(host):
+    """Get the docker client of a host, shared by all threads of a process."""
+    return _get_client(host['name'], host['base_url'])
+
+
+def is_local(host):
+    """Return True if the host's containers run on this machine."""
+    return host['base_url'] is None or \
+        host['base_url'].startswith('unix://')
+
+
+def get_internal_address(host):
+    """Get the address the service reaches the host's containers at."""
+    if is_local(host):
+        return 'localhost'
+    return urlparse(host['base_url']).hostname
+
+
+def rank_hosts(loads, policy=PLACEMENT):
+    """Order host names by preference given the share of each host in use."""
+    if policy == 'bin_packing':
+        return sorted(loads, key=lambda name: -loads[name])
+    elif policy == 'least_loaded':
+        return sorted(loads, key=lambda name: loads[name])
+    raise ValueError('Unknown placement policy: %s' % policy)
@@ -0,0 +1,370 @@
+"""An in-process stand-in for a docker daemon.
+
+This implements the parts of the docker client the service uses, so that
+the service can be run and tested without docker, for instance with several
+fake hosts in CWC_DOCKER_HOSTS (see docker_hosts.py). A fake host is given as
+
+    fake://<bind address>?boot=<seconds>&warm_boot=<seconds>&stop=<seconds>
+           &cpus=<n>&mem_gb=<n>
+
+After booting for the given number of seconds, a container answers HTTP
+requests on the bind address and the host ports it publishes, so the
+service's readiness check works as with a real container. The fake daemon
+lives in the process that created it, so the service has to run in a single
+process to use it.
+"""
+import io
+import itertools
+import time
+import calendar
+import uuid
+import queue
+import tarfile
+import threading
+from collections import namedtuple
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from docker.errors import NotFound, ImageNotFound
+
+import logging
+logger = logging.getLogger('fake-docker')
+
+
+ExecResult = namedtuple('ExecResult', ['exit_code', 'output'])
+
+
+class _ReadyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'<html><body>Fake dialogue</body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeImage(object):
+    def __init__(self, name, labels=None, committed=False,
+                 exposed_ports=(8000, 3000)):
+        self.tags = [name]
+        self.exposed_ports = exposed_ports
+        self.committed = committed
+        self.id = 'sha256:' + uuid.uuid4().hex * 2
+        self.labels = labels or {}
+        self.attrs = {'Id': self.id, 'Config': {'Labels': self.labels}}
+
+
+class FakeContainer(object):
+    def __init__(self, client, image, command, labels=None, ports=None,
+                 **kwargs):
+        self.client = client
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.name = 'fake_%s' % self.id[:10]
+        self.image = image
+        self.command = command
+        self.labels = labels or {}
+        self.run_kwargs = kwargs
+        self.host_ports = {int(cont_port.split('/')[0]): int(host_port)
+                           for cont_port, host_port in (ports or {}).items()}
+        # A container that publishes no port gets an address of its own,
+        # like on a docker network, and listens there on the image's ports.
+        self.ip_address = client.bind_address if self.host_ports else \
+            client._next_address()
+        self.created = datetime.utcnow()
+        self.status = 'created'
+        self._log_lines = []
+        self._log_lock = threading.Lock()
+        self._servers = []
+        self._booted = threading.Event()
+
+    @property
+    def attrs(self):
+        return {'Id': self.id,
+                'Name': '/' + self.name,
+                'Names': ['/' + self.name],
+                'Created': self.created.strftime('%Y-%m-%dT%H:%M:%S.%f') +
+                '000Z',
+                'State': self.status,
+                'Labels': self.labels,
+                'Config': {'Labels': self.labels},
+                'HostConfig': {'CpusetCpus':
+                               self.run_kwargs.get('cpuset_cpus', '')},
+                'Ports': [{'PrivatePort': cont_port, 'PublicPort': host_port,
+                           'Type': 'tcp'}
+                          for cont_port, host_port in
+                          self.host_ports.items()],
+                'NetworkSettings': {'IPAddress': self.ip_address}}
+
+    @property
+    def ports(self):
+        return {'%d/tcp' % cont_port: [{'HostIp': '0.0.0.0',
+                                        'HostPort': str(host_port)}]
+                for cont_port, host_port in self.host_ports.items()}
+
+    def write_log(self, text):
+        """Add a line to the output of the container."""
+        with self._log_lock:
+            self._log_lines.append((time.time(), text.encode('utf-8')))
+
+    def log_activity(self):
+        """Add a line the service takes as a sign of user activity."""
+        self.write_log('SPG: ;; [%s]'
+                       % datetime.utcnow().strftime('%m/%d/%Y %H:%M:%S'))
+
+    def _boot(self):
+        self.write_log('Starting %s' % self.command)
+        # Images committed from a booted container stand for warm images,
+        # which boot faster as what is loaded at boot is already on disk.
+        time.sleep(self.client.warm_boot_delay if self.image.committed
+                   else self.client.boot_delay)
+        if self.status != 'running':
+            return
+        ports = self.host_ports.values() if self.host_ports else \
+            self.image.exposed_ports
+        for port in ports:
+            try:
+                server = ThreadingHTTPServer((self.ip_address, port),
+                                             _ReadyHandler)
+            except OSError as e:
+                logger.warning('Fake container %s could not listen on %d: '
+                               '%s' % (self.name, port, e))
+                continue
+            threading.Thread(target=server.serve_forever,
+                             daemon=True).start()
+            self._servers.append(server)
+        self.write_log('Ready')
+        self._booted.set()
+
+    def start(self):
+        self.status = 'running'
+        self.client._emit(self, 'start')
+        threading.Thread(target=self._boot, daemon=True).start()
+
+    def stop(self, timeout=None):
+        if self.status != 'running':
+            return
+        time.sleep(self.client.stop_delay)
+        self._exit()
+
+    def kill(self):
+        self._exit()
+
+    def _exit(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        self.status = 'exited'
+        self.client._emit(self, 'die')
+        self.client._emit(self, 'stop')
+
+    def restart(self, timeout=None):
+        self.stop()
+        self.start()
+
+    def remove(self, force=False):
+        if force:
+            self.kill()
+        self.client._containers.pop(self.id, None)
+
+    def reload(self):
+        if self.id not in self.client._containers:
+            raise NotFound('No such container: %s' % self.id)
+
+    def attach(self, **kwargs):
+        return b''
+
+    def wait(self, timeout=None):
+        return {'StatusCode': 0}
+
+    def logs(self, since=None, until=None, stream=False, **kwargs):
+        # Like docker, naive datetimes are taken to be in UTC.
+        since, until = [calendar.timegm(t.timetuple())
+                        if isinstance(t, datetime) else t
+                        for t in (since, until)]
+        with self._log_lock:
+            lines = [line for stamp, line in self._log_lines
+                     if (since is None or stamp >= since) and
+                     (until is None or stamp < until)]
+        if stream:
+            return iter([line + b'\n' for line in lines])
+        return b''.join(line + b'\n' for line in lines)
+
+    def exec_run(self, cmd, **kwargs):
+        if self.status != 'running':
+            raise NotFound('Container %s is not running' % self.id)
+        return ExecResult(0, b'')
+
+    def get_archive(self, path, chunk_size=2*1024*1024):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tarf:
+            data = ('Fake content of %s\n' % path).encode('utf-8')
+            info = tarfile.TarInfo(path.strip('/').split('/')[-1] + '.txt')
+            info.size = len(data)
+            tarf.addfile(info, io.BytesIO(data))
+        return iter([buf.getvalue()]), {'name': path}
+
+    def stats(self, stream=False, **kwargs):
+        usage = 1000000000 if self.status == 'running' else 0
+        return {'cpu_stats': {'cpu_usage': {'total_usage': usage},
+                              'system_cpu_usage': 2 * usage,
+                              'online_cpus': self.client.num_cpus},
+                'precpu_stats': {'cpu_usage': {'total_usage': 0},
+                                 'system_cpu_usage': 0},
+                'memory_stats': {'usage': 512 * 1024**2, 'stats': {}}}
+
+    def commit(self, repository=None, tag=None, changes=None, **kwargs):
+        name = '%s:%s' % (repository, tag or 'latest')
+        if isinstance(changes, str):
+            changes = [changes]
+        labels = dict(self.image.labels)
+        for change in changes or []:
+            if change.startswith('LABEL '):
+                key, _, value = change[len('LABEL '):].partition('=')
+                labels[key] = value
+        image = FakeImage(name, labels, committed=True,
+                          exposed_ports=self.image.exposed_ports)
+        self.client._images[name] = image
+        return image
+
+
+class FakeContainerCollection(object):
+    def __init__(self, client):
+        self.client = client
+
+    def run(self, image, command=None, detach=False, labels=None,
+            ports=None, **kwargs):
+        cont = FakeContainer(self.client, self.client.images.get(image),
+                             command, labels=labels, ports=ports, **kwargs)
+        self.client._containers[cont.id] = cont
+        cont.start()
+        return cont
+
+    def get(self, cont_id):
+        cont = self.client._containers.get(cont_id)
+        if cont is None:
+            raise NotFound('No such container: %s' % cont_id)
+        return cont
+
+    def list(self, all=False, filters=None, sparse=False, **kwargs):
+        conts = [cont for cont in list(self.client._containers.values())
+                 if all or cont.status == 'running']
+        filters = filters or {}
+        ids = filters.get('id')
+        if isinstance(ids, str):
+            ids = [ids]
+        return [cont for cont in conts
+                if _matches(cont, filters.get('label')) and
+                (ids is None or any(cont.id.startswith(i) for i in ids))]
+
+
+class FakeImageCollection(object):
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, name):
+        if ':' not in name:
+            name += ':latest'
+        if name not in self.client._images:
+            raise ImageNotFound('No such image: %s' % name)
+        return self.client._images[name]
+
+    def list(self, name=None, **kwargs):
+        return [image for tag, image in self.client._images.items()
+                if name is None or tag.startswith(name)]
+
+
+def _matches(cont, label_filters):
+    if label_filters is None:
+        return True
+    if isinstance(label_filters, str):
+        label_filters = [label_filters]
+    for label_filter in label_filters:
+        key, _, value = label_filter.partition('=')
+        if key not in cont.labels or (value and cont.labels[key] != value):
+            return False
+    return True
+
+
+_client_nums = itertools.count()
+
+
+class FakeDockerClient(object):
+    """A fake docker daemon with the interface of docker.DockerClient."""
+    def __init__(self, bind_address='127.0.0.1', boot_delay=0.0,
+                 stop_delay=0.0, num_cpus=16, mem_total=64*1024**3,
+                 images=('cwc-integ:dev',), warm_boot_delay=None):
+        self.bind_address = bind_address
+        self.boot_delay = boot_delay
+        self.warm_boot_delay = boot_delay if warm_boot_delay is None \
+            else warm_boot_delay
+        self.stop_delay = stop_delay
+        self.num_cpus = num_cpus
+        self.mem_total = mem_total
+        self._containers = {}
+        self._images = {name: FakeImage(name) for name in images}
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+        self._num_addresses = 0
+        self._client_num = next(_client_nums) % 100
+        self.containers = FakeContainerCollection(self)
+        self.images = FakeImageCollection(self)
+
+    @classmethod
+    def from_url(cls, url):
+        """Make a fake daemon from a fake://<address>?<options> url."""
+        parsed = urlparse(url)
+        opts = {key: vals[0] for key, vals in parse_qs(parsed.query).items()}
+        return cls(bind_address=parsed.hostname or '127.0.0.1',
+                   boot_delay=float(opts.get('boot', 0)),
+                   warm_boot_delay=float(opts['warm_boot'])
+                   if 'warm_boot' in opts else None,
+                   stop_delay=float(opts.get('stop', 0)),
+                   num_cpus=int(opts.get('cpus', 16)),
+                   mem_total=int(float(opts.get('mem_gb', 64)) * 1024**3))
+
+    def _next_address(self):
+        """Get a loopback address for a container without published ports.
+        """
+        with self._subscribers_lock:
+            self._num_addresses += 1
+            num = self._num_addresses
+        return '127.%d.%d.%d' % (100 + self._client_num, num // 250,
+                                 num % 250 + 1)
+
+    def info(self):
+        return {'NCPU': self.num_cpus, 'MemTotal': self.mem_total,
+                'Containers': len(self._containers)}
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+    def _emit(self, cont, action):
+        event = {'Type': 'container', 'Action': action, 'status': action,
+                 'id': cont.id, 'time': int(time.time()),
+                 'Actor': {'ID': cont.id, 'Attributes': dict(cont.labels)}}
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for filters, events in subscribers:
+            if filters.get('event') and action not in filters['event']:
+                continue
+            if not _matches(cont, filters.get('label')):
+                continue
+            events.put(event)
+
+    def events(self, decode=False, filters=None, **kwargs):
+        events = queue.Queue()
+        with self._subscribers_lock:
+            self._subscribers.append((filters or {}, events))
+
+        def _stream():
+            while True:
+                yield events.get()
+        return _stream()
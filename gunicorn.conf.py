@@ -0,0 +1,9 @@
+"""gunicorn settings of the service, see start."""
+# Workers that are stopped or replaced (see reload) first finish starting and
+# ending the sessions they were working on, which can take a while.
+graceful_timeout = 600
+
+
+def worker_exit(server, worker):
+    import cwc_integ_app
+    cwc_integ_app.finish_background_work()
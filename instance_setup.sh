@@ -28,12 +28,26 @@ sudo systemctl daemon-reload
 sudo systemctl restart docker
 sudo apt-get install nginx
 # Add
+# map $http_upgrade $connection_upgrade {
+#     default upgrade;
+#     ''      '';
+# }
+# upstream cwc_integ_service {
+#     server <server's public IP>:8080;
+#     keepalive 16;
+# }
 # server {
 #    listen 80;
 #    server_name <server's public IP>;
 #
 #     location / {
-#         proxy_pass http://<server's public IP>:8080;
+#         proxy_pass http://cwc_integ_service;
+#         proxy_http_version 1.1;
+#         proxy_set_header Host $host;
+#         proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+#         proxy_set_header Upgrade $http_upgrade;
+#         proxy_set_header Connection $connection_upgrade;
+#         proxy_read_timeout 3600;
 #         }
 #}
 # to /etc/nginx/sites-available/cwc_integ_service
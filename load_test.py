@@ -0,0 +1,282 @@
+"""Measure how the service behaves with many users launching sessions.
+
+The service is run in this process against in-process fakes: docker hosts
+from fake_docker.py, with the given boot and stop delays, and a mongomock
+database (mongomock has to be installed). Simulated users go through the
+index page, launch a session, wait until it is ready, keep it for a while and
+end it, all through the Flask app. Latency percentiles, throughput and a check
+that every slot, port and core was given back are reported at the end.
+Saving the logs of ended sessions is left out unless --save-logs is given, in
+which case they are uploaded to an in-memory S3 (moto has to be installed).
+
+    python3 load_test.py --users 20 --hosts 2 --max-sessions 4 --boot 5
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+from collections import defaultdict
+from logs.simulate_capacity import percentile
+
+import logging
+logger = logging.getLogger('load-test')
+
+
+class Stats(object):
+    """Latencies and outcomes collected from all simulated users."""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.latencies[name].append(seconds)
+
+    def count(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] += 1
+
+
+def _poll(client, url, done, interval, time_out):
+    """Get a json url until done says so, return the last response."""
+    start = time.time()
+    while True:
+        resp = client.get(url)
+        data = resp.get_json(silent=True) or {}
+        if done(resp.status_code, data) or time.time() - start > time_out:
+            return resp.status_code, data
+        time.sleep(interval)
+
+
+def run_user(app_module, user_num, args, stats):
+    """Go through the sessions of one simulated user."""
+    client = app_module.app.test_client()
+    for session_num in range(args.sessions_per_user):
+        time.sleep(random.uniform(0, args.think_time))
+        endpoint = random.choice(args.interfaces)
+        start = time.time()
+        client.get('/')
+        stats.add('index', time.time() - start)
+
+        start = time.time()
+        resp = client.post(endpoint, data={
+            'csrf_token': 'load-%d-%d-%f' % (user_num, session_num,
+                                             random.random()),
+            'user_name': 'user%d' % user_num,
+            'user_email': 'user%d@example.org' % user_num})
+        stats.add('launch_request', time.time() - start)
+        match = re.search(rb'queue_status/(\w+)', resp.data)
+        if resp.status_code != 200 or match is None:
+            stats.count('launch_error')
+            continue
+        ticket = match.group(1).decode()
+
+        status, data = _poll(
+            client, '/queue_status/%s' % ticket,
+            lambda code, data: data.get('status') in
+            ('launched', 'rejected', 'failed', 'unknown'),
+            args.poll, args.time_out)
+        if data.get('status') != 'launched':
+            stats.count(data.get('status', 'timed_out'))
+            continue
+        stats.add('time_to_session', time.time() - start)
+        page = client.get('/queue_session/%s' % ticket).data
+        cont_id = re.search(rb'session_ready/(\w+)', page).group(1).decode()
+
+        status, data = _poll(
+            client, '/session_ready/%s' % cont_id,
+            lambda code, data: data.get('ready') or code != 200 or
+            data.get('status') in ('exited', 'dead', 'removed'),
+            args.poll, args.time_out)
+        if not data.get('ready'):
+            stats.count('not_ready')
+        else:
+            stats.add('time_to_ready', time.time() - start)
+            stats.count('launched')
+
+        time.sleep(random.uniform(0.5, 1.5) * args.session_length)
+
+        start = time.time()
+        resp = client.delete('/end_session/%s' % cont_id)
+        stats.add('end_request', time.time() - start)
+        if resp.status_code != 202:
+            stats.count('end_error')
+            continue
+        job_id = resp.get_json()['job_id']
+        status, data = _poll(
+            client, '/end_session_status/%s' % job_id,
+            lambda code, data: data.get('status') in ('done', 'failed'),
+            args.poll, args.time_out)
+        if data.get('status') == 'done':
+            stats.add('teardown', time.time() - start)
+            stats.count('ended')
+        else:
+            stats.count('teardown_' + data.get('status', 'timed_out'))
+
+
+def check_accounting(app_module):
+    """Check that the slots, ports and cores in use match the containers.
+
+    Returns a list of the problems found.
+    """
+    db = app_module.mongo.db
+    problems = []
+    counts = app_module._get_session_counts()
+    port_range = app_module.PORT_RANGE
+    for host in app_module.HOSTS:
+        records = list(db.containers.find({'host': host}))
+        if counts.get(host, 0) != len(records):
+            problems.append('%s counts %d sessions for %d containers.'
+                            % (host, counts.get(host, 0), len(records)))
+        used_ports = [rec['port'] for rec in records
+                      if rec.get('port') is not None]
+        free_ports = [doc['port'] for doc in db.free_ports.find({'host': host})]
+        if len(set(used_ports + free_ports)) != len(used_ports + free_ports):
+            problems.append('%s has ports both free and in use.' % host)
+        if len(used_ports) + len(free_ports) != \
+                port_range[1] - port_range[0] + 1:
+            problems.append('%s lost ports: %d in use, %d free.'
+                            % (host, len(used_ports), len(free_ports)))
+        used_cores = [core for rec in records for core in rec.get('cores')
+                      or []]
+        free_cores = [doc['core'] for doc in db.free_cores.find({'host': host})]
+        if set(used_cores) & set(free_cores):
+            problems.append('%s has cores both free and in use.' % host)
+        running = {cont.id for cont in app_module.get_docker_client(host)
+                   .containers.list(filters={'label':
+                                             app_module.SESSION_LABEL})}
+        registered = {rec['_id'] for rec in records}
+        if running - registered:
+            problems.append('%s runs %d containers that are not registered.'
+                            % (host, len(running - registered)))
+        if registered - running:
+            problems.append('%s has %d registered containers that are not '
+                            'running.' % (host, len(registered - running)))
+    num_warm = db.warm_pool.count_documents({'container_id': {'$ne': None}})
+    num_warm_records = db.containers.count_documents({'warm': True})
+    if num_warm != num_warm_records:
+        problems.append('The warm pool has %d containers but %d are '
+                        'registered as warm.' % (num_warm, num_warm_records))
+    return problems
+
+
+def report(stats, elapsed, problems, save_logs):
+    if save_logs:
+        print('Logs of ended sessions were saved to a fake S3.')
+    else:
+        print('Logs of ended sessions were NOT saved, so teardown leaves out '
+              'the log upload (see --save-logs).')
+    print('')
+    print('%-16s %6s %8s %8s %8s %8s' % ('latency (s)', 'n', 'p50', 'p90',
+                                         'p99', 'max'))
+    for name in ['index', 'launch_request', 'time_to_session',
+                 'time_to_ready', 'end_request', 'teardown']:
+        values = stats.latencies.get(name, [])
+        print('%-16s %6d %8.3f %8.3f %8.3f %8.3f'
+              % (name, len(values), percentile(values, 50),
+                 percentile(values, 90), percentile(values, 99),
+                 max(values) if values else 0.0))
+    print('')
+    for outcome, num in sorted(stats.outcomes.items()):
+        print('%-16s %6d' % (outcome, num))
+    print('%-16s %9.3f sessions/s over %.1fs'
+          % ('throughput', stats.outcomes.get('ended', 0) / elapsed,
+             elapsed))
+    print('')
+    if problems:
+        print('Slot accounting FAILED:')
+        for problem in problems:
+            print('  ' + problem)
+    else:
+        print('Slot accounting OK.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Load test the service against fake docker hosts and Mongo')
+    parser.add_argument('--users', type=int, default=10,
+                        help='The number of concurrent simulated users.')
+    parser.add_argument('--sessions-per-user', type=int, default=2)
+    parser.add_argument('--hosts', type=int, default=1,
+                        help='The number of fake docker hosts.')
+    parser.add_argument('--max-sessions', type=int, default=4,
+                        help='The session limit of each host.')
+    parser.add_argument('--boot', type=float, default=2.0,
+                        help='Seconds a fake container takes to be ready.')
+    parser.add_argument('--stop', type=float, default=0.5,
+                        help='Seconds a fake container takes to stop.')
+    parser.add_argument('--session-length', type=float, default=5.0,
+                        help='Mean seconds a user keeps a session.')
+    parser.add_argument('--think-time', type=float, default=2.0,
+                        help='Most seconds a user waits before launching.')
+    parser.add_argument('--warm', type=int, default=0,
+                        help='The warm pool size of each interface.')
+    parser.add_argument('--interfaces', nargs='+',
+                        default=['/launch_clic', '/launch_sbgn'])
+    parser.add_argument('--poll', type=float, default=0.2,
+                        help='Seconds between status requests.')
+    parser.add_argument('--time-out', type=float, default=300,
+                        help='Most seconds to wait for a status change.')
+    parser.add_argument('--port-range', default='20000-20999')
+    parser.add_argument('--save-logs', action='store_true',
+                        help='Save the logs of ended sessions to a fake S3.')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    # The service reads its configuration when it is imported.
+    hosts = [{'name': 'fake%d' % num,
+              'base_url': 'fake://127.0.1.%d?boot=%s&stop=%s'
+                          % (num + 1, args.boot, args.stop),
+              'max_sessions': args.max_sessions}
+             for num in range(args.hosts)]
+    os.environ['CWC_DOCKER_HOSTS'] = json.dumps(hosts)
+    os.environ['CWC_PORT_RANGE'] = args.port_range
+    os.environ['CWC_WARM_CLIC'] = os.environ['CWC_WARM_SBGN'] = \
+        str(args.warm)
+    # All simulated users come from the same address.
+    os.environ['CWC_MAX_SESSIONS_PER_IP'] = \
+        os.environ['CWC_MAX_LAUNCHES_PER_IP'] = '0'
+    import mongomock
+    import cwc_integ_app
+    from logs import get_logs
+    db = mongomock.MongoClient().db
+    cwc_integ_app.mongo.db = get_logs.db = db
+    if args.save_logs:
+        # The local copies go to a temporary folder, the uploads to moto.
+        from moto import mock_aws
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        mock_aws().start()
+        get_logs.get_s3().create_bucket(Bucket=get_logs.S3_BUCKET)
+        cwc_integ_app.LOGS_LOCAL_DIR = tempfile.mkdtemp(prefix='cwc-logs-')
+    else:
+        cwc_integ_app.get_logs_for_container = lambda *args, **kwargs: ()
+    cwc_integ_app.reset_sessions()
+    cwc_integ_app._fill_warm_pool()
+
+    stats = Stats()
+    start = time.time()
+    threads = [threading.Thread(target=run_user,
+                                args=(cwc_integ_app, num, args, stats))
+               for num in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    # Let background refills of the warm pool finish before checking.
+    cwc_integ_app.finish_background_work()
+    problems = check_accounting(cwc_integ_app)
+    report(stats, elapsed, problems, args.save_logs)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import io
 import os
 import re
 import json
@@ -5,9 +6,17 @@ import tqdm
 import boto3
 import docker
 import tarfile
+import sys
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from datetime import datetime, timedelta, timezone
 from pymongo import MongoClient
 from indra.util.aws import get_s3_file_tree, get_s3_client
+from prometheus_client import Histogram
+
+# The service's own modules are one folder up when this is run from here.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from per_process import per_process
 
 import logging
 logger = logging.getLogger('log-getter')
@@ -17,6 +26,27 @@ HERE = os.path.dirname(__file__)
 MONGO_URI = 'mongodb://localhost:27017/myDatabase'
 db = MongoClient(MONGO_URI).get_database('myDatabase')
 
+S3_BUCKET = 'cwc-hms'
+S3_PREFIX = 'bob_ec2_logs/'
+# Logs are streamed to S3 in parts of this size (at least 5MB), with at most
+# S3_MAX_PARTS parts of a file in memory at a time.
+S3_PART_SIZE = int(os.environ.get('CWC_S3_PART_SIZE', 8*1024*1024))
+S3_MAX_PARTS = 4
+# The number of connections to S3 kept per process.
+S3_POOL_SIZE = int(os.environ.get('CWC_S3_POOL_SIZE', 10))
+# Whether a copy of the logs uploaded to S3 is kept in the local directory.
+KEEP_LOCAL_LOGS = os.environ.get('CWC_KEEP_LOCAL_LOGS', '1') == '1'
+
+# Served at /metrics with the other metrics of the service (see metrics.py).
+LOG_TASK_SECONDS = Histogram(
+    'cwc_log_task_seconds',
+    'Time taken by each step of saving the logs of a container.',
+    ['task'], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+S3_UPLOAD_SECONDS = Histogram(
+    'cwc_s3_upload_seconds',
+    'Time taken to upload a log file to S3, as it is read from docker.',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
 
 def c_ls(container, dirname):
     started = False
@@ -32,139 +62,174 @@ def c_ls(container, dirname):
     return res.output.decode().splitlines()
 
 
-def get_run_logs(cont, log_dir):
+def get_run_logs(cont, since=None):
     dir_conts = c_ls(cont, 'cwc-integ')
     possible_results = [p for p in dir_conts if p.startswith('20')]
     if not possible_results:
         return None
     my_result = max(possible_results)
-    # Write to spcified log directory
-    arch_name = os.path.join(
-        log_dir,
-        '%s_%s.tar.gz' % (make_cont_name(cont), my_result)
-    )
-    with open(arch_name, 'wb') as f:
-        bts, meta = cont.get_archive('/sw/cwc-integ/' + my_result)
-        for bit in bts:
-            f.write(bit)
-    return arch_name
-
-
-def get_session_logs(cont, log_dir):
-    # Write to spcified log directory
-    fname = os.path.join(
-        log_dir,
-        '%s_%s.log' % (make_cont_name(cont), format_cont_date(cont))
-    )
-    with open(fname, 'wb') as f:
-        f.write(cont.logs())
-    return fname
+    arch_name = '%s_%s.tar.gz' % (make_cont_name(cont, since), my_result)
+    bts, meta = cont.get_archive('/sw/cwc-integ/' + my_result)
+    return arch_name, bts
 
 
-def get_folder_gz(cont, path, log_dir, arch_name):
+def get_session_logs(cont, since=None):
+    fname = '%s_%s.log' % (make_cont_name(cont, since),
+                           format_cont_date(cont, since))
+    return fname, cont.logs(stream=True, follow=False, since=since)
+
+
+def get_folder_gz(cont, path, arch_name):
     try:
         bts, meta = cont.get_archive(path)
     except Exception as e:
         logger.warning('Failed to get files from %s.' % path)
         return None
-    # Write to spcified log directory
-    arch_fname = os.path.join(log_dir, arch_name)
-    with open(arch_fname, 'wb') as f:
-        for bit in bts:
-            f.write(bit)
-    return arch_fname
+    return arch_name, bts
 
 
-def get_ba_session_data(cont, log_dir):
-    arch_name = get_folder_gz(cont,
+def get_ba_session_data(cont, since=None):
+    return get_folder_gz(cont,
         '/sw/cwc-integ/clic/session-data',
-        log_dir,
-        '%s_ba_session_data.tar.gz' % make_cont_name(cont))
-    return arch_name
+        '%s_ba_session_data.tar.gz' % make_cont_name(cont, since))
 
 
-def get_bioagent_images(cont, log_dir):
-    arch_name = get_folder_gz(cont,
+def get_bioagent_images(cont, since=None):
+    return get_folder_gz(cont,
         '/sw/cwc-integ/hms/bioagents/bioagents/images',
-        log_dir,
-        '%s_bioagent_images.tar.gz' % make_cont_name(cont))
-    return arch_name
+        '%s_bioagent_images.tar.gz' % make_cont_name(cont, since))
 
 
 def get_user_session_dict(cont_name):
-    session = {}
-    sessions = db.session_users.find()
-    if sessions is None:
+    # A recycled container has one session per user, the latest is wanted.
+    sessions = list(db.session_users.find({'container_name': cont_name})
+                    .sort('_id', -1).limit(1))
+    if not sessions:
         return {}
-    for sess in sessions:
-        if cont_name == sess['container_name']:
-            session = sess.copy()
-            session.pop('_id')
-            break
-
+    session = sessions[0]
+    session.pop('_id')
     return session
 
 
-def get_user_info(cont, log_dir):
+def get_user_info(cont, since=None):
     info_dict = get_user_session_dict(cont.name)
-    fname = os.path.join(log_dir, '%s_user_info.json' % make_cont_name(cont))
-    with open(fname, 'w') as f:
-        json.dump(info_dict, f)
-    return fname
+    fname = '%s_user_info.json' % make_cont_name(cont, since)
+    return fname, [json.dumps(info_dict).encode('utf-8')]
 
 
-def format_cont_date(cont):
+def format_cont_date(cont, since=None):
+    # The session of a recycled container starts after the container does.
+    if since:
+        return since.strftime('%Y-%m-%d-%H-%M-%S')
     cont_date = ('-'.join(cont.attrs['Created'].replace(':', '-')
                  .replace('.', '-').split('-')[:-1]))
     return cont_date
 
 
-def make_cont_name(cont):
-    cont_date = datetime.strptime(cont.attrs['Created'].split('.')[0],
-                                  '%Y-%m-%dT%H:%M:%S')
+def make_cont_name(cont, since=None):
+    cont_date = since or \
+        datetime.strptime(cont.attrs['Created'].split('.')[0],
+                          '%Y-%m-%dT%H:%M:%S')
     img_id = '%s-%s' % (cont.image.attrs['Id'].split(':')[1][:12],
                         cont_date.strftime('%Y%m%d%H%M%S'))
     return '%s_%s_%s' % (img_id, cont.attrs['Id'][:12], cont.name)
 
 
-def get_logs_for_container(cont, interface, local_dir):
+def get_logs_for_container(cont, interface, local_dir, since=None):
+    """Stream the logs of a container to S3, keeping a local copy if set to.
+
+    If since is given, only the session that started at that time is saved,
+    which is needed for containers that are reused across sessions. Returns
+    the local paths of the files, which are also their keys on S3 after the
+    prefix.
+    """
     tasks = [get_session_logs, get_run_logs, get_bioagent_images,
              get_ba_session_data, get_user_info]
     fnames = []
     for task in tasks:
-        # Get the logs.
-        fname_path = task(cont, local_dir)
-        if not fname_path:
-            logger.info('No output found for %s' % str(task))
-            continue
-        fname = fname_path.split(os.path.sep)[-1]
-
-        # Rename the log file. This is a little hacky, but it should work.
-        new_fname = interface + '-' + fname
-        new_fname_path = fname_path.replace(fname, new_fname)
-        os.rename(fname_path, new_fname_path)
-        fname = new_fname
-        fname_path = new_fname_path
+        with LOG_TASK_SECONDS.labels(task.__name__).time():
+            # Get the logs.
+            output = task(cont, since)
+            if not output:
+                logger.info('No output found for %s' % str(task))
+                continue
+            fname, chunks = output
+            fname_path = os.path.join(local_dir, interface + '-' + fname)
 
-        # Add the file to s3.
-        logger.info("Saved %s locally." % fname_path)
+            # Add the file to s3.
+            with S3_UPLOAD_SECONDS.time():
+                _stream_to_s3(chunks, fname_path)
         fnames.append(fname_path)
-        _dump_on_s3(fname_path)
     return tuple(fnames)
 
 
-def _dump_on_s3(fname):
-    s3 = boto3.client('s3')
-    s3_bucket = 'cwc-hms'
-    s3_prefix = 'bob_ec2_logs/'
-    if not fname:
-        return
-    mode = 'r' if fname.endswith('.json') else 'rb'
-    with open(fname, mode) as f:
-        s3.put_object(Key=s3_prefix + fname, Body=f.read(),
-                      Bucket=s3_bucket)
+class _ChunkReader(io.RawIOBase):
+    """A file object over an iterator of bytes, read as it is consumed.
+
+    What is read is also written to copy if given.
+    """
+    def __init__(self, chunks, copy=None):
+        self.chunks = iter(chunks)
+        self.copy = copy
+        self.left = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.left:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                return 0
+            if self.copy is not None:
+                self.copy.write(chunk)
+            self.left = memoryview(chunk)
+        num = min(len(buf), len(self.left))
+        buf[:num] = self.left[:num]
+        self.left = self.left[num:]
+        return num
+
+
+@per_process
+def get_s3():
+    """Get the S3 client, shared by all threads of a process."""
+    return boto3.session.Session().client(
+        's3', config=Config(max_pool_connections=S3_POOL_SIZE))
+
+
+def _get_transfer_config():
+    config = TransferConfig(multipart_threshold=S3_PART_SIZE,
+                            multipart_chunksize=S3_PART_SIZE,
+                            max_concurrency=2)
+    # Parts are read from a stream, so they have to be held in memory until
+    # they are uploaded.
+    config.max_in_memory_upload_chunks = S3_MAX_PARTS
+    return config
+
+
+def _stream_to_s3(chunks, fname):
+    """Upload an iterator of bytes to S3 under the prefix and fname."""
+    copy = open(fname, 'wb') if KEEP_LOCAL_LOGS else None
+    reader = _ChunkReader(chunks, copy)
+    try:
+        # Buffered so that every part but the last has the full part size.
+        get_s3().upload_fileobj(io.BufferedReader(reader), S3_BUCKET,
+                                S3_PREFIX + fname,
+                                Config=_get_transfer_config())
+    except Exception:
+        # Keep what could not be uploaded locally.
+        if copy is not None:
+            for chunk in reader.chunks:
+                copy.write(chunk)
+            logger.info("Saved %s locally." % fname)
+        raise
+    finally:
+        if copy is not None:
+            copy.close()
+    if copy is not None:
+        logger.info("Saved %s locally." % fname)
     logger.info("%s dumped on s3." % fname)
-    return
 
 
 def get_logs(local_storage=HERE):
@@ -216,7 +281,7 @@ def get_logs_from_s3(folder=None, cached=True, past_days=None):
                 tzinfo=timezone.utc) if isinstance(past_days, int) else None)
     else:
         days_ago = None
-    tree = get_s3_file_tree(s3, 'cwc-hms', 'bob_ec2_logs', days_ago)
+    tree = get_s3_file_tree(s3, S3_BUCKET, S3_PREFIX.rstrip('/'), days_ago)
     keys = tree.gets('key')
     # Here we only get the tar.gz files which contain the logs for the
     # facilitator + the json file (if present) of the user data
@@ -0,0 +1,342 @@
+"""Replay past sessions against capacity policies to size a deployment.
+
+Sessions are read from the transcripts.json written by process_logs.py, with
+the duration of each session taken from the entries of its facilitator log,
+and/or from the session_history collection the service keeps. They are then
+replayed in a discrete-event simulation of the service: a limited number of
+session slots, a launch queue users may give up on, containers that take
+time to boot, pools of warm containers, and sessions that are held until the
+idle timeout when users leave without ending them. For each session limit
+given, the wait times, rejection and abandonment rates and utilization are
+reported.
+
+    python3 simulate_capacity.py --transcripts transcripts.json \
+        --max-sessions 2 4 6 8 --warm 1
+"""
+import re
+import json
+import heapq
+import random
+import logging
+import argparse
+from os import path
+from collections import deque
+from datetime import datetime
+from pymongo import MongoClient
+
+logger = logging.getLogger('capacity_simulator')
+
+MONGO_URI = 'mongodb://localhost:27017/myDatabase'
+YMD_DT = '%Y-%m-%d-%H-%M-%S'
+# The T attribute of facilitator log entries, the time since the log started.
+entry_time_patt = re.compile('<[SR]\s+T=\"([\d.:]+)\"')
+
+
+class Session(object):
+    def __init__(self, start, duration, interface):
+        self.start = start
+        self.duration = duration
+        self.interface = interface
+
+    def __repr__(self):
+        return 'Session(%s, %ds, %s)' % (self.start, self.duration,
+                                        self.interface)
+
+
+def _parse_entry_time(time_str):
+    """Get the seconds from a [[h:]m:]s time string."""
+    seconds = 0.0
+    for part in time_str.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_log_duration(log_file):
+    """Get the seconds between the first and last entry of a log, or None."""
+    if not path.isfile(log_file):
+        return None
+    with open(log_file, 'r') as f:
+        times = [_parse_entry_time(t)
+                 for t in entry_time_patt.findall(f.read())]
+    if not times:
+        return None
+    return max(times) - min(times)
+
+
+def load_transcripts(json_path, default_duration):
+    """Get the sessions listed in a transcripts.json."""
+    with open(json_path, 'r') as f:
+        transcripts = json.load(f)
+    sessions = []
+    for html_path, start in transcripts:
+        log_dir = path.dirname(html_path)
+        duration = get_log_duration(path.join(log_dir, 'log.txt'))
+        if duration is None:
+            logger.warning('No log entries found for %s, using the default '
+                           'duration.' % log_dir)
+            duration = default_duration
+        name = path.basename(log_dir).upper()
+        interface = 'SBGN' if name.startswith('SBGN') else 'CLIC'
+        sessions.append(Session(datetime.strptime(start, YMD_DT), duration,
+                                interface))
+    logger.info('Loaded %d sessions from %s.' % (len(sessions), json_path))
+    return sessions
+
+
+def load_session_history(mongo_uri=MONGO_URI):
+    """Get the sessions the service recorded in its session_history."""
+    db = MongoClient(mongo_uri).get_database('myDatabase')
+    sessions = [Session(doc['start'], doc['duration'], doc['interface'])
+                for doc in db.session_history.find()]
+    logger.info('Loaded %d sessions from the session history.'
+                % len(sessions))
+    return sessions
+
+
+def percentile(values, pct):
+    """Get the nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(round(pct / 100.0 * len(values))) - 1)]
+
+
+class CapacitySimulation(object):
+    """A discrete-event simulation of the service's session slots.
+
+    Parameters
+    ----------
+    max_sessions : int
+        The number of session slots, warm containers included.
+    max_queue : int
+        The most users waiting in the launch queue, others are rejected.
+    patience : float
+        The seconds a queued user waits before giving up.
+    boot_time : dict
+        The seconds a container of each interface takes to boot.
+    warm : dict
+        The number of warm containers kept for each interface.
+    idle_timeout : float
+        The seconds a session left open is kept before it is stopped.
+    max_duration : float
+        The longest a session is kept.
+    abandon_rate : float
+        The share of users that leave without ending their session.
+    """
+    def __init__(self, max_sessions, max_queue=20, patience=600,
+                 boot_time=None, warm=None, idle_timeout=7200,
+                 max_duration=43200, abandon_rate=0.5, seed=0):
+        self.max_sessions = max_sessions
+        self.max_queue = max_queue
+        self.patience = patience
+        self.boot_time = boot_time or {'CLIC': 30, 'SBGN': 60}
+        self.warm = warm or {'CLIC': 0, 'SBGN': 0}
+        self.idle_timeout = idle_timeout
+        self.max_duration = max_duration
+        self.abandon_rate = abandon_rate
+        self.random = random.Random(seed)
+
+    def _schedule(self, time, kind, data=None):
+        self.seq += 1
+        heapq.heappush(self.events, (time, self.seq, kind, data))
+
+    def _advance(self, now):
+        # Integrate the slots in use over time for the utilization.
+        self.slot_seconds += self.used * (now - self.last_change)
+        self.session_seconds += self.in_session * (now - self.last_change)
+        self.last_change = now
+
+    def _set_used(self, used):
+        self.used = used
+        self.peak = max(self.peak, used)
+
+    def _hold_time(self, session):
+        """Get how long a session keeps its slot once it started."""
+        hold = session.duration
+        if self.random.random() < self.abandon_rate:
+            hold += self.idle_timeout
+        return min(hold, self.max_duration)
+
+    def _start(self, now, arrival, session, boot):
+        """Start a session that already holds a slot."""
+        self.waits.append(now - arrival + boot)
+        self.in_session += 1
+        self._schedule(now + boot + self._hold_time(session), 'end')
+
+    def _fill_warm(self, now):
+        if self.queue:
+            return
+        for interface, size in self.warm.items():
+            while self.warm_ready[interface] + self.warm_booting[interface] \
+                    < size and self.used < self.max_sessions:
+                self._set_used(self.used + 1)
+                self.warm_booting[interface] += 1
+                self._schedule(now + self.boot_time[interface], 'warm_ready',
+                               interface)
+
+    def _dispatch(self, now):
+        """Give free slots to the users at the head of the queue."""
+        while self.queue and self.used < self.max_sessions:
+            arrival, session, entry = self.queue.popleft()
+            if entry['gone']:
+                continue
+            entry['gone'] = True
+            self._set_used(self.used + 1)
+            self._start(now, arrival, session,
+                        self.boot_time[session.interface])
+
+    def run(self, sessions, arrival_scale=1.0):
+        """Replay the sessions and return a dict of results.
+
+        The time between arrivals is multiplied by arrival_scale, so that
+        a scale of 0.5 stands for twice as many users.
+        """
+        sessions = sorted(sessions, key=lambda sess: sess.start)
+        if not sessions:
+            return {}
+        first = sessions[0].start
+        self.events = []
+        self.seq = 0
+        self.queue = deque()
+        self.used = self.in_session = self.peak = 0
+        self.slot_seconds = self.session_seconds = 0.0
+        self.last_change = 0.0
+        self.warm_ready = {interface: 0 for interface in self.warm}
+        self.warm_booting = {interface: 0 for interface in self.warm}
+        self.waits = []
+        rejected = abandoned = 0
+        for session in sessions:
+            offset = (session.start - first).total_seconds() * arrival_scale
+            self._schedule(offset, 'arrival', session)
+        self._fill_warm(0.0)
+
+        now = 0.0
+        while self.events:
+            now, _, kind, data = heapq.heappop(self.events)
+            self._advance(now)
+            if kind == 'arrival':
+                session = data
+                if self.warm_ready.get(session.interface):
+                    self.warm_ready[session.interface] -= 1
+                    self._start(now, now, session, 0)
+                elif not self.queue and self.used < self.max_sessions:
+                    self._set_used(self.used + 1)
+                    self._start(now, now, session,
+                                self.boot_time[session.interface])
+                elif len(self.queue) < self.max_queue:
+                    entry = {'gone': False}
+                    self.queue.append((now, session, entry))
+                    self._schedule(now + self.patience, 'give_up', entry)
+                else:
+                    rejected += 1
+            elif kind == 'give_up':
+                if not data['gone']:
+                    data['gone'] = True
+                    abandoned += 1
+            elif kind == 'end':
+                self.in_session -= 1
+                self._set_used(self.used - 1)
+                self._dispatch(now)
+            elif kind == 'warm_ready':
+                interface = data
+                self.warm_booting[interface] -= 1
+                # A queued user of the interface takes it right away.
+                for arrival, session, entry in self.queue:
+                    if not entry['gone'] and session.interface == interface:
+                        entry['gone'] = True
+                        self._start(now, arrival, session, 0)
+                        break
+                else:
+                    self.warm_ready[interface] += 1
+            self.queue = deque(item for item in self.queue
+                               if not item[2]['gone'])
+            self._fill_warm(now)
+
+        num = len(sessions)
+        return {'max_sessions': self.max_sessions,
+                'sessions': num,
+                'served': len(self.waits),
+                'rejected': rejected / num,
+                'abandoned': abandoned / num,
+                'mean_wait': sum(self.waits) / max(1, len(self.waits)),
+                'p50_wait': percentile(self.waits, 50),
+                'p90_wait': percentile(self.waits, 90),
+                'p99_wait': percentile(self.waits, 99),
+                'max_wait': max(self.waits) if self.waits else 0.0,
+                'utilization': self.slot_seconds /
+                (self.max_sessions * now) if now else 0.0,
+                'session_utilization': self.session_seconds /
+                (self.max_sessions * now) if now else 0.0,
+                'peak': self.peak}
+
+
+def print_results(results):
+    columns = [('max_sessions', '%6d'), ('sessions', '%8d'),
+               ('served', '%7d'), ('rejected', '%8.1f%%'),
+               ('abandoned', '%9.1f%%'), ('mean_wait', '%9.0fs'),
+               ('p50_wait', '%8.0fs'), ('p90_wait', '%8.0fs'),
+               ('p99_wait', '%8.0fs'), ('max_wait', '%8.0fs'),
+               ('utilization', '%10.1f%%'),
+               ('session_utilization', '%10.1f%%')]
+    print(' '.join(name[:10].rjust(len(fmt % 0)) for name, fmt in columns))
+    for res in results:
+        print(' '.join(fmt % (res[name] * 100 if fmt.endswith('%%')
+                              else res[name]) for name, fmt in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Simulate the service with past sessions to choose its capacity')
+    parser.add_argument('--transcripts', nargs='*', default=[],
+                        help='transcripts.json files written by '
+                             'process_logs.py.')
+    parser.add_argument('--history', action='store_true',
+                        help='Also use the session_history of the service.')
+    parser.add_argument('--max-sessions', type=int, nargs='+',
+                        default=[2, 4, 6, 8],
+                        help='The session limits to compare.')
+    parser.add_argument('--max-queue', type=int, default=20)
+    parser.add_argument('--patience', type=float, default=600,
+                        help='Seconds a queued user waits before leaving.')
+    parser.add_argument('--warm', type=int, default=0,
+                        help='The warm pool size of each interface.')
+    parser.add_argument('--boot-clic', type=float, default=30)
+    parser.add_argument('--boot-sbgn', type=float, default=60)
+    parser.add_argument('--idle-timeout', type=float, default=2*3600)
+    parser.add_argument('--max-duration', type=float, default=12*3600)
+    parser.add_argument('--abandon-rate', type=float, default=0.5,
+                        help='Share of users that leave their session open '
+                             'until it times out.')
+    parser.add_argument('--default-duration', type=float, default=1800,
+                        help='Seconds assumed for sessions without a log.')
+    parser.add_argument('--arrival-scale', type=float, default=1.0,
+                        help='Multiplies the time between arrivals, 0.5 '
+                             'simulates twice the traffic.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(format=('%(levelname)s: [%(asctime)s] %(name)s'
+                                ' - %(message)s'),
+                        level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+
+    sessions = []
+    for json_path in args.transcripts:
+        sessions += load_transcripts(json_path, args.default_duration)
+    if args.history:
+        sessions += load_session_history()
+    if not sessions:
+        parser.error('No sessions given, use --transcripts or --history.')
+
+    results = []
+    for max_sessions in args.max_sessions:
+        sim = CapacitySimulation(
+            max_sessions, max_queue=args.max_queue, patience=args.patience,
+            boot_time={'CLIC': args.boot_clic, 'SBGN': args.boot_sbgn},
+            warm={'CLIC': args.warm, 'SBGN': args.warm},
+            idle_timeout=args.idle_timeout, max_duration=args.max_duration,
+            abandon_rate=args.abandon_rate, seed=args.seed)
+        results.append(sim.run(sessions, args.arrival_scale))
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
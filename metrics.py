@@ -0,0 +1,73 @@
+"""Prometheus metrics of the service, served at /metrics.
+
+If PROMETHEUS_MULTIPROC_DIR is set, the metrics of every process using it,
+the gunicorn workers and the monitor, are served together. The directory has
+to be emptied before the service starts (see start). The metrics of saving
+logs are defined in logs/get_logs.py, which is also run on its own.
+"""
+from os import environ
+from prometheus_client import Counter, Histogram, CollectorRegistry, \
+    REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+# Buckets in seconds, from quick docker calls to containers that take
+# minutes to boot or to save their logs.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+RUN_CONTAINER_SECONDS = Histogram(
+    'cwc_run_container_seconds',
+    'Time taken to take a slot for and start a session container.',
+    ['interface', 'host'], buckets=BUCKETS)
+RUN_CONTAINER_FAILURES = Counter(
+    'cwc_run_container_failures_total',
+    'Session containers that could not be started.',
+    ['interface', 'reason'])
+STOP_CONTAINER_SECONDS = Histogram(
+    'cwc_stop_container_seconds',
+    'Time taken to end a session, including saving its logs.',
+    ['interface', 'outcome'], buckets=BUCKETS)
+LAUNCH_WAIT_SECONDS = Histogram(
+    'cwc_launch_wait_seconds',
+    'Time from a launch request until its session was started.',
+    ['interface', 'queued'], buckets=BUCKETS + (1800, 3600))
+CHECK_TIMERS_SECONDS = Histogram(
+    'cwc_check_timers_seconds',
+    'Time taken by a pass of the session timers check.',
+    buckets=BUCKETS)
+QUOTA_REJECTIONS = Counter(
+    'cwc_quota_rejections_total',
+    'Launches refused for going over a per user or address quota.',
+    ['quota'])
+SESSION_TIMEOUTS = Counter(
+    'cwc_session_timeouts_total',
+    'Sessions ended by the service for being idle or too long.',
+    ['reason'])
+
+
+class StateCollector(object):
+    """Report the current allocation state as gauges when scraped.
+
+    get_state returns a list of (name, documentation, label name, values)
+    tuples, where values maps label values to the gauge values.
+    """
+    def __init__(self, get_state):
+        self.get_state = get_state
+
+    def collect(self):
+        for name, doc, label, values in self.get_state():
+            gauge = GaugeMetricFamily(name, doc, labels=[label])
+            for label_value, value in sorted(values.items()):
+                gauge.add_metric([label_value], value)
+            yield gauge
+
+
+def generate(state_collector):
+    """Get the metrics in the Prometheus text format."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    state_registry = CollectorRegistry()
+    state_registry.register(state_collector)
+    return generate_latest(registry) + generate_latest(state_registry)
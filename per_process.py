@@ -0,0 +1,30 @@
+"""Objects that each process of the service makes for itself.
+
+The service runs in gunicorn workers forked from a master process. Clients
+inherited through a fork would share their connections with the parent, and
+threads are not carried over a fork at all, so such objects are made on first
+use in the process that uses them, and shared by its threads from then on.
+"""
+import os
+import threading
+
+
+def per_process(make):
+    """Wrap make so that it is called once per process and set of arguments.
+
+    The returned function gets what make returned for the same arguments in
+    this process, and calls it if there is nothing yet.
+    """
+    made = {}
+    lock = threading.Lock()
+    pid = [None]
+
+    def get(*args):
+        with lock:
+            if pid[0] != os.getpid():
+                made.clear()
+                pid[0] = os.getpid()
+            if args not in made:
+                made[args] = make(*args)
+            return made[args]
+    return get
@@ -0,0 +1,147 @@
+"""Forwarding of user requests to session containers.
+
+When the service routes sessions itself (CWC_ROUTING=proxy), users reach
+their dialogue at /session/<container id>/ on the service, and the requests
+are forwarded from there to the container. HTTP requests go through a pool of
+kept-alive upstream connections, websocket upgrades are tunneled over the
+client's socket, which needs the service to run in gunicorn.
+"""
+import socket
+import select
+import urllib3
+from os import environ
+from per_process import per_process
+
+import logging
+logger = logging.getLogger('session-proxy')
+
+# The number of kept-alive connections to each container per process.
+POOL_SIZE = int(environ.get('CWC_PROXY_POOL_SIZE', 10))
+# The number of containers connections are kept to per process.
+NUM_POOLS = int(environ.get('CWC_PROXY_NUM_POOLS', 50))
+TIMEOUT = urllib3.Timeout(connect=5, read=300)
+# How long a websocket can go without traffic before it is closed.
+TUNNEL_IDLE_TIMEOUT = 3600
+CHUNK_SIZE = 64*1024
+
+# Headers that only apply to one connection and are not forwarded.
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-authenticate',
+              'proxy-authorization', 'te', 'trailers', 'transfer-encoding',
+              'upgrade'}
+
+
+@per_process
+def get_pool():
+    """Get the upstream connection pool, shared by all threads of a process.
+    """
+    return urllib3.PoolManager(num_pools=NUM_POOLS, maxsize=POOL_SIZE,
+                               retries=False, timeout=TIMEOUT)
+
+
+def _strip_cookies(cookie_header, names):
+    """Remove the named cookies from a Cookie header."""
+    return '; '.join(cookie.strip() for cookie in cookie_header.split(';')
+                     if cookie.split('=', 1)[0].strip() not in names)
+
+
+def get_request_headers(environ, address, port, prefix, strip_cookies=()):
+    """Get the headers to send upstream from a WSGI environ.
+
+    The cookies named in strip_cookies are not sent.
+    """
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            name = key[len('HTTP_'):].replace('_', '-').title()
+        elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+            name = key.replace('_', '-').title()
+        else:
+            continue
+        if name.lower() in HOP_BY_HOP:
+            continue
+        if name == 'Cookie':
+            value = _strip_cookies(value, strip_cookies)
+            if not value:
+                continue
+        headers[name] = value
+    headers['Host'] = '%s:%d' % (address, port)
+    headers['X-Forwarded-For'] = environ.get('REMOTE_ADDR', '')
+    headers['X-Forwarded-Host'] = environ.get('HTTP_HOST', '')
+    headers['X-Forwarded-Proto'] = environ.get('wsgi.url_scheme', 'http')
+    headers['X-Forwarded-Prefix'] = prefix
+    return headers
+
+
+def forward(method, address, port, path, headers, body, prefix):
+    """Send a request to a container.
+
+    Returns the status, the headers and an iterator over the body of the
+    response, which gives the connection back to the pool once consumed.
+    """
+    resp = get_pool().urlopen(method, 'http://%s:%d%s' % (address, port, path),
+                              headers=headers, body=body, redirect=False,
+                              preload_content=False)
+    resp_headers = []
+    for name, value in resp.headers.items():
+        if name.lower() in HOP_BY_HOP:
+            continue
+        # Keep redirects within the session's prefix.
+        if name.lower() == 'location' and value.startswith('/'):
+            value = prefix + value
+        resp_headers.append((name, value))
+
+    def _stream():
+        try:
+            for chunk in resp.stream(CHUNK_SIZE, decode_content=False):
+                yield chunk
+        finally:
+            resp.release_conn()
+    return resp.status, resp_headers, _stream()
+
+
+def is_upgrade(environ):
+    """Return True if the request asks to switch to a websocket."""
+    return environ.get('HTTP_UPGRADE', '').lower() == 'websocket'
+
+
+def tunnel(environ, address, port, path, headers):
+    """Connect the client of a websocket request to a container.
+
+    This blocks until either side closes the connection. Returns False if
+    the server doesn't give access to the client's socket.
+    """
+    client = environ.get('gunicorn.socket')
+    if client is None:
+        return False
+    headers = dict(headers, Upgrade=environ['HTTP_UPGRADE'],
+                   Connection='Upgrade')
+    request = 'GET %s HTTP/1.1\r\n' % path + \
+        ''.join('%s: %s\r\n' % item for item in headers.items()) + '\r\n'
+    upstream = socket.create_connection((address, port), timeout=5)
+    upstream.settimeout(None)
+    client.settimeout(None)
+    try:
+        upstream.sendall(request.encode('latin-1'))
+        socks = [client, upstream]
+        while True:
+            readable, _, _ = select.select(socks, [], [], TUNNEL_IDLE_TIMEOUT)
+            if not readable:
+                logger.info('Closing idle websocket to %s:%d.'
+                            % (address, port))
+                return True
+            for sock in readable:
+                data = sock.recv(CHUNK_SIZE)
+                if not data:
+                    return True
+                (upstream if sock is client else client).sendall(data)
+    except OSError as e:
+        logger.info('Websocket to %s:%d closed: %s' % (address, port, e))
+        return True
+    finally:
+        upstream.close()
+        # The response to the upgrade came from the container, so nothing
+        # more can be written to the client.
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass